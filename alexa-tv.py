@@ -16,8 +16,12 @@ Tips:
 import fauxmo
 import logging
 import debounce_handler
-import subprocess
+import lgtv
+import metrics
 import json
+import os
+import socket
+import threading
 import time
 import argparse
 
@@ -25,12 +29,12 @@ import argparse
 LOG_LEVEL = logging.DEBUG
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=LOG_LEVEL, datefmt='%H:%M:%S')
 
-# TV Configuration
+# TV Configuration, a --config file can override any of it
 MAX_VOLUME = 100
 DEFAULT_TRIGGERS = ['tv', 'volume', 'mute', 'playback']
 SET_VOLUME_CONTROLS = range(0, MAX_VOLUME+1)  # Range of values you can set the volume to
 CHANGE_VOLUME_CONTROLS = range(1, 11)  # Values you can change the volume by
-# TODO: Automatically generate this based on listApps response?
+# With --auto_apps, every app installed on the TV gets a trigger named after its title too
 APPS = {  # Dictionary of trigger name to app ID
     'netflix': 'netflix',
     'youtube': 'youtube.leanback.v4',
@@ -42,49 +46,112 @@ INPUTS = {  # Dictionary of trigger name to input
     'playstation': 'HDMI_2',
     'pc': 'HDMI_3',
 }
+MACROS = {  # Dictionary of trigger name to the steps run on "turn on", see lgtv.LGTVMacro
+    # 'movie night': [{'command': 'setInput', 'input_id': 'HDMI_1'}, {'command': 'setVolume', 'level': 25},
+    #                 {'command': 'startApp', 'appid': 'netflix'}],
+    # Or separate steps for "turn on" and "turn off"
+    # 'quiet': {'on': [{'command': 'setVolume', 'level': 5}], 'off': [{'command': 'setVolume', 'level': 20}]},
+}
+HANDSHAKE_TIMEOUT = 5  # Seconds to wait for the TV to accept the stored client key
+IDLE_TIMEOUT = 600  # Seconds before an unused TV connection is closed
+HEARTBEAT_SECONDS = 10  # How often TV connections are pinged to notice dead ones
+TV_PORT_STRIDE = 200  # Port offset between the triggers of one TV and the next
+CONFIG_CHECK_SECONDS = 2  # How often the --config file is checked for changes
+VOLUME_COALESCE_SECONDS = 0.25  # Volume requests within this window are sent as one setVolume
 
+# Volume up is the only way I know how to unmute, then volume down to keep the same volume level
+UNMUTE = lgtv.LGTVMacro([{'command': 'volumeUp'}, {'command': 'volumeDown'}])
 
-def lgtv_call(command, before_msg=None, after_msg=None, popen=False):
-    """Run specified LGWebOSRemote command using subprocess.call.
-
-    Arguments:
-        command (str):       command to run in the format 'python lgtv.py <command>'
-        before_msg (str):    message to print before command is run
-        after_msg (str):     message to print after command is run
-        popen (bool):        whether to use subprocess.Popen instead of subprocess.call
+ACT_SECONDS = metrics.histogram('alexa_tv_act_seconds', 'Time device_handler.act() took per command type', ['command', 'state'])
 
-    Returns:
-        True if success
-    """
-    if before_msg:
-        logging.info(before_msg)
 
-    args = ['python', 'lgtv.py'] + command.split()
-    if popen:  # Don't wait for the process to return
-        subprocess.Popen(args)
-    else:
-        subprocess.call(args)
+def load_config(path=None):
+    """Return the trigger configuration: the JSON file at path over the defaults above.
 
-    if after_msg:
-        logging.info(after_msg)
+    Example file:
+        {"apps": {"netflix": "netflix", "plex": "cdp-30"}, "inputs": {"pc": "HDMI_3"},
+         "default_triggers": ["tv", "volume", "mute", "playback"],
+         "max_volume": 60, "set_volume": [0, 60], "change_volume": [1, 10],
+         "macros": {"movie night": [{"command": "setInput", "input_id": "HDMI_1"}, {"command": "startApp", "appid": "netflix"}]}}
 
-    return True
+    Macros are turned into (on, off) pairs of lgtv.LGTVMacro, or None for a
+    state without steps. Raises ValueError for a file that isn't JSON, a key
+    of the wrong type or range, or a macro step that isn't a valid command.
+    """
+    config = {
+        'max_volume': MAX_VOLUME,
+        'default_triggers': DEFAULT_TRIGGERS,
+        'apps': APPS,
+        'inputs': INPUTS,
+        'set_volume': [min(SET_VOLUME_CONTROLS), max(SET_VOLUME_CONTROLS)],
+        'change_volume': [min(CHANGE_VOLUME_CONTROLS), max(CHANGE_VOLUME_CONTROLS)],
+        'macros': MACROS,
+    }
+    if path is not None:
+        with open(path) as f:
+            overrides = utf8(json.loads(f.read()))
+        if not isinstance(overrides, dict):
+            raise ValueError('The configuration must be a JSON object')
+        config.update(overrides)
+    check_config(config)
+    macros = {}
+    for name, steps in config['macros'].items():
+        if not isinstance(steps, dict):
+            steps = {'on': steps}
+        macros[name] = tuple(lgtv.LGTVMacro(steps[state]) if steps.get(state) else None for state in ('on', 'off'))
+    config['macros'] = macros
+    return config
+
+
+def utf8(value):
+    """value from json.loads with its unicode strings encoded as UTF-8 str, like the names above"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [utf8(item) for item in value]
+    if isinstance(value, dict):
+        return dict((utf8(key), utf8(item)) for key, item in value.items())
+    return value
+
+
+def check_config(config):
+    """Raise ValueError unless config has the keys and types load_config() documents."""
+    def names(value):
+        return isinstance(value, list) and all(isinstance(name, basestring) for name in value)
+
+    def name_map(value):
+        return isinstance(value, dict) and all(isinstance(item, basestring) for item in value.keys() + value.values())
+
+    def int_range(value, low, high):
+        return (isinstance(value, list) and len(value) == 2 and all(type(item) is int for item in value)
+                and low <= value[0] <= value[1] <= high)
+
+    if type(config['max_volume']) is not int or not 0 <= config['max_volume'] <= MAX_VOLUME:
+        raise ValueError('max_volume must be a number from 0 to {}'.format(MAX_VOLUME))
+    if not names(config['default_triggers']):
+        raise ValueError('default_triggers must be a list of trigger names')
+    for key in ('apps', 'inputs'):
+        if not name_map(config[key]):
+            raise ValueError('{} must map trigger names to IDs'.format(key))
+    if not int_range(config['set_volume'], 0, MAX_VOLUME):
+        raise ValueError('set_volume must be [lowest, highest] from 0 to {}'.format(MAX_VOLUME))
+    if not int_range(config['change_volume'], 1, MAX_VOLUME):
+        raise ValueError('change_volume must be [smallest, largest] from 1 to {}'.format(MAX_VOLUME))
+    if not isinstance(config['macros'], dict):
+        raise ValueError('macros must map trigger names to steps')
+    for name, steps in config['macros'].items():
+        states = steps if isinstance(steps, dict) else {'on': steps}
+        if not isinstance(name, basestring) or set(states) - set(['on', 'off']) or \
+                not all(isinstance(state_steps, list) for state_steps in states.values()):
+            raise ValueError('Macro {} must be a list of steps, or {{"on": [...], "off": [...]}}'.format(name))
 
 
 class device_handler(debounce_handler.debounce_handler):
-    """Publishes the on/off state requested and the IP address of the Echo making the request."""
-    triggers = {}
-
-    last_input = None
-    current_input = None
-
-    unknown_volume_status = True
-    current_volume = None
-    muted = None
-
-    set_volume_controls = map(str, SET_VOLUME_CONTROLS)
-    change_volume_controls = map(lambda x: 'c{}'.format(x), CHANGE_VOLUME_CONTROLS)
+    """Publishes the on/off state requested and the IP address of the Echo making the request.
 
+    There is one handler per TV. Its triggers are named "<prefix><trigger>" and
+    its commands go out on the pool's connection to its TV.
+    """
     # Define starting port for triggers
     # Give each category of triggers its own range to prevent interference when adding new triggers
     DEFAULT_TRIGGERS_START_PORT = 52000
@@ -92,6 +159,68 @@ class device_handler(debounce_handler.debounce_handler):
     INPUTS_START_PORT = 54000
     SET_VOLUME_START_PORT = 55000
     CHANGE_VOLUME_START_PORT = 56000
+    MACROS_START_PORT = 57000
+
+    def __init__(self, pool, tv_id=lgtv.LGTVRegistry.DEFAULT_TV, prefix='', port_offset=0, config=None, app_index=None, executor=None):
+        """
+        Arguments:
+            pool (LGTVPool):   connections to the TVs
+            tv_id (str):       id of this handler's TV in the pool's registry
+            prefix (str):      prepended to every trigger name, e.g. 'bedroom ' for "bedroom netflix"
+            port_offset (int): added to every trigger port, so the triggers of different TVs don't collide
+            config (dict):     trigger configuration from load_config(), the defaults if None
+            app_index (LGTVAppIndex): apps installed on the TV, to generate app triggers from
+            executor (keyed_executor): runs the triggers' actions, the coalesced setVolume joins their queue
+        """
+        super(device_handler, self).__init__()
+        self.pool = pool
+        self.tv_id = tv_id
+        self.prefix = prefix
+        self.port_offset = port_offset
+        self.triggers = {}
+        self.app_index = app_index
+        self.configure(config or load_config())
+
+        self.client = None  # Connection the volume subscription was made on
+        self.client_lock = threading.Lock()
+
+        self.last_input = None
+        self.current_input = None
+
+        self.unknown_volume_status = True
+        self.current_volume = None
+        self.muted = None
+        self.volume_subscription = None
+
+        self.executor = executor
+        self.pending_volume = None  # Target of the volume requests being coalesced
+        self.volume_timer = None
+        self.volume_lock = threading.Lock()
+
+    def configure(self, config):
+        """Use a trigger configuration from load_config(), call init_triggers() after to rebuild the triggers."""
+        # Work everything out before changing anything, so a failure leaves the handler as it was
+        set_volume_controls = map(str, range(config['set_volume'][0], config['set_volume'][1] + 1))
+        change_volume_controls = map(lambda x: 'c{}'.format(x), range(config['change_volume'][0], config['change_volume'][1] + 1))
+        apps = dict(config['apps'])
+        if self.app_index is not None:
+            taken = set(config['default_triggers']) | set(config['inputs']) | set(config['macros']) | set(set_volume_controls) | set(change_volume_controls)
+            for title, app_id in self.app_index.apps().items():
+                # Configured triggers win over generated ones
+                if title not in apps and title not in taken:
+                    apps[title] = app_id
+
+        self.max_volume = config['max_volume']
+        self.default_triggers = config['default_triggers']
+        self.inputs = config['inputs']
+        self.macros = config['macros']
+        self.set_volume_controls = set_volume_controls
+        self.change_volume_controls = change_volume_controls
+        self.apps = apps
+
+    def dispatch_key(self, name):
+        """Commands for one TV run one at a time, different TVs in parallel."""
+        return self.tv_id
 
     def add_triggers(self, trigger_names, start_port=None, args=None):
         """Add specified trigger names to internal dictionary of trigger names to ports.
@@ -106,66 +235,155 @@ class device_handler(debounce_handler.debounce_handler):
             if trigger_name in self.set_volume_controls:
                 value = int(trigger_name)
                 if value >= args.set_volume_start and value <= args.set_volume_end:
-                    self.triggers[trigger_name] = self.SET_VOLUME_START_PORT + value
+                    self.triggers[self.prefix + trigger_name] = self.SET_VOLUME_START_PORT + value + self.port_offset
             elif trigger_name in self.change_volume_controls:
-                self.triggers[trigger_name] = self.CHANGE_VOLUME_START_PORT + int(trigger_name.lstrip('c'))
+                self.triggers[self.prefix + trigger_name] = self.CHANGE_VOLUME_START_PORT + int(trigger_name.lstrip('c')) + self.port_offset
             else:  # Otherwise, use specified port
-                self.triggers[trigger_name] = start_port + i
+                self.triggers[self.prefix + trigger_name] = start_port + i + self.port_offset
 
     def init_triggers(self, args):
         """Initialize triggers based on configuration."""
+        self.triggers = {}
         if args.all or args.default:
-            self.add_triggers(DEFAULT_TRIGGERS, self.DEFAULT_TRIGGERS_START_PORT)
-        if args.all or args.apps:
-            self.add_triggers(APPS.keys(), self.APPS_START_PORT)
+            self.add_triggers(self.default_triggers, self.DEFAULT_TRIGGERS_START_PORT)
+        if args.all or args.apps or args.auto_apps:
+            self.add_triggers(self.apps.keys(), self.APPS_START_PORT)
         if args.all or args.inputs:
-            self.add_triggers(INPUTS.keys(), self.INPUTS_START_PORT)
+            self.add_triggers(self.inputs.keys(), self.INPUTS_START_PORT)
+        if args.all or args.macros:
+            self.add_triggers(self.macros.keys(), self.MACROS_START_PORT)
 
         # Only add volume controls if volume is a default trigger
-        if 'volume' in DEFAULT_TRIGGERS:
+        if 'volume' in self.default_triggers:
             if args.all or args.set_volume:
                 self.add_triggers(self.set_volume_controls, args=args)
             if args.all or args.change_volume:
                 self.add_triggers(self.change_volume_controls)
 
-        logging.info('Triggers: {}'.format(self.triggers))
+        logging.info('Triggers for TV {}: {}'.format(self.tv_id, self.triggers))
 
-    def check_volume_status(self):
-        """Check and current volume/whether muted and update internal status.
+    def get_client(self):
+        """Return the pool's paired connection to this handler's TV, subscribing to volume and app events on a new one.
 
         Returns:
-            True if success, False if bad response
+            LGTVClient, or None if the TV couldn't be reached or is still booting
         """
-        # Use Popen to get the response
-        pipe = subprocess.PIPE
-        process = subprocess.Popen(['python', 'lgtv.py', 'audioVolume'], stdin=pipe, stdout=pipe, stderr=pipe)
-        output, error = process.communicate()
+        return self.use_client(self.pool.get(self.tv_id))
+
+    def use_client(self, client):
+        """Make client the connection events come from, returns it."""
+        with self.client_lock:
+            if client is None:
+                self.client = None
+                self.unknown_volume_status = True
+            elif client is not self.client:
+                # Volume events stop with the previous connection
+                self.client = client
+                self.subscribe_volume_status(client)
+                if self.app_index is not None:
+                    self.app_index.subscribe(client)
+        return client
+
+    def lgtv_call(self, command, before_msg=None, after_msg=None, **kwargs):
+        """Run specified LGWebOSRemote command on the resident TV connection.
+
+        Arguments:
+            command (str):       name of the LGTVClient command to run, e.g. 'setVolume'
+            before_msg (str):    message to print before command is run
+            after_msg (str):     message to print after command is run
+            kwargs:              arguments for the command, e.g. level=10
+
+        Returns:
+            True if success
+        """
+        if before_msg:
+            logging.info(before_msg)
+
+        if command == 'on':  # Wake-on-LAN doesn't need (and can't get) a connection
+            if not self.pool.power_on(self.tv_id):
+                return False
+        elif self.pool.when_ready(self.tv_id, lambda client: getattr(self.use_client(client), command)(**kwargs)):
+            logging.info('TV {} is still booting, {} runs once it is up'.format(self.tv_id, command))
+        else:
+            client = self.get_client()
+            if client is None:
+                return False
+            getattr(client, command)(**kwargs)
+
+        if after_msg:
+            logging.info(after_msg)
+
+        return True
+
+    def run_macro(self, macro, before_msg=None, after_msg=None):
+        """Run an lgtv.LGTVMacro on the resident TV connection, its steps pipelined.
+
+        Arguments:
+            macro (LGTVMacro):   steps to run
+            before_msg (str):    message to print before the macro is run
+            after_msg (str):     message to print once every step succeeded
+
+        Returns:
+            True if every step succeeded, or the macro waits for the TV to boot
+        """
+        if before_msg:
+            logging.info(before_msg)
+
+        def run(client):
+            failures = macro.failures(macro.run(client))
+            for command, response in failures:
+                logging.error('{} failed on TV {}: {}'.format(command, self.tv_id, response))
+            if not failures and after_msg:
+                logging.info(after_msg)
+            return not failures
+
+        if self.pool.when_ready(self.tv_id, lambda client: run(self.use_client(client))):
+            logging.info('TV {} is still booting, the steps run once it is up'.format(self.tv_id))
+            return True
+        client = self.get_client()
+        if client is None:
+            return False
+        return run(client)
+
+    def subscribe_volume_status(self, client):
+        """Keep the cached volume/mute status current through a getVolume subscription on the given connection."""
         self.unknown_volume_status = True
-        try:
-            response, closing = output.rstrip('\n').split('\n')  # Except two responses separated by newline with trailing newline
-        except:
-            logging.error('Bad audioVolume response: couldn\'t load volume/mute status')
+        self.volume_subscription = client.subscribeVolume(self.update_volume_status)
+
+    def update_volume_status(self, response):
+        """Update the cached volume/mute status from a getVolume subscription response or change event.
+
+        Arguments:
+            response (dict): SSAP message, e.g. {"type": "response", "payload": {"volume": 10, "muted": false}}
+        """
+        payload = response.get('payload') or {}
+        if response.get('type') == 'error' or payload.get('returnValue') is False:
+            logging.error('Bad volume status event: {}'.format(response))
+            self.unknown_volume_status = True
             return
 
-        # Load response
-        try:
-            response_json = json.loads(response)
-        except Exception as e:
-            logging.error('volumeStatus response is not JSON: {}'.format(response))
-            logging.error('json.loads exception: {}'.format(e))
-            return False
-        try:
-            payload = response_json['payload']
-            self.current_volume = payload['volume']
-            self.muted = payload['muted']
-        except Exception as e:
-            logging.error('bad volumeStatus response: {}'.format(e))
-            return False
+        # Newer WebOS versions nest the status in volumeStatus
+        status = payload.get('volumeStatus', payload)
+        if 'volume' in status:
+            self.current_volume = status['volume']
+        if 'muted' in status:
+            self.muted = status['muted']
+        elif 'muteStatus' in status:
+            self.muted = status['muteStatus']
 
         logging.debug('Current volume: {}'.format(self.current_volume))
         logging.debug('Muted: {}'.format(self.muted))
-        self.unknown_volume_status = False
-        return True
+        self.unknown_volume_status = self.current_volume is None or self.muted is None
+
+    def check_volume_status(self):
+        """Make sure the cached volume/mute status is known, waiting for the first subscription event if needed.
+
+        Returns:
+            True if the status is known, False otherwise
+        """
+        if self.get_client() is not None and self.unknown_volume_status:
+            self.volume_subscription.wait(HANDSHAKE_TIMEOUT)
+        return not self.unknown_volume_status
 
     # TODO: Use state to decide whether to turn on/off mute?
     # Currently, mute will stay on when setting/changing volume
@@ -175,11 +393,7 @@ class device_handler(debounce_handler.debounce_handler):
         Arguments:
             name (str): trigger name, expected to be an integer in string format
         """
-        volume_to_set = int(name)
-        if volume_to_set == self.current_volume:
-            logging.info('Volume is already {}'.format(self.current_volume))
-        else:
-            lgtv_call('setVolume {}'.format(volume_to_set), 'Volume set to {}'.format(volume_to_set))
+        self.queue_volume(int(name))
 
     def change_volume(self, name, state):
         """Increase/decrease volume by the specified amount.
@@ -188,18 +402,73 @@ class device_handler(debounce_handler.debounce_handler):
             name (str):   trigger name with expected format c<delta>, where delta is an integer in string format
             state (bool): whether to increase or decrease volume
         """
-        if self.unknown_volume_status:
-            logging.error('Can\'t change volume: unknown current volume')
-            return
-
         delta = int(name.lstrip('c'))
-        volume_to_set = self.current_volume + delta if state is True else self.current_volume - delta
-        if volume_to_set > MAX_VOLUME:
-            # Set volume to max instead
-            logging.error('Change volume: requested volume ({}) over max ({})'.format(volume_to_set, MAX_VOLUME))
-            lgtv_call('setVolume {}'.format(volume_to_set), 'Volume set to max volume of {}'.format(MAX_VOLUME))
+        self.queue_volume(delta if state is True else -delta, relative=True)
+
+    def queue_volume(self, volume, relative=False):
+        """Merge a volume request into the pending target, sent as one setVolume once the coalescing window ends.
+
+        Relative changes apply on top of the pending target, so increments arriving in a burst aren't lost.
+
+        Arguments:
+            volume (int):     volume to set, or amount to change the volume by if relative
+            relative (bool):  whether volume is a change from the current/pending volume
+        """
+        with self.volume_lock:
+            if relative:
+                if self.pending_volume is None and self.unknown_volume_status:
+                    logging.error('Can\'t change volume: unknown current volume')
+                    return
+                volume += self.pending_volume if self.pending_volume is not None else self.current_volume
+
+            if volume > self.max_volume:
+                logging.error('Requested volume ({}) over max ({}), using max instead'.format(volume, self.max_volume))
+                volume = self.max_volume
+            self.pending_volume = max(volume, 0)
+
+            if self.volume_timer is None:
+                self.volume_timer = threading.Timer(VOLUME_COALESCE_SECONDS, self.volume_window_ended)
+                self.volume_timer.daemon = True
+                self.volume_timer.start()
+
+    def volume_window_ended(self):
+        # Through the executor, so the setVolume keeps its place among this TV's other commands
+        if self.executor is not None:
+            self.executor.submit(self.dispatch_key(None), self.flush_volume)
         else:
-            lgtv_call('setVolume {}'.format(volume_to_set), 'Volume changed from {} to {}'.format(self.current_volume, volume_to_set))
+            self.flush_volume()
+
+    def flush_volume(self):
+        """Send the pending volume target to the TV, if there is one."""
+        with self.volume_lock:
+            volume_to_set, self.pending_volume = self.pending_volume, None
+            if self.volume_timer is not None:
+                self.volume_timer.cancel()
+                self.volume_timer = None
+            if volume_to_set is None:
+                return
+            previous_volume = self.current_volume
+            if volume_to_set == previous_volume:
+                logging.info('Volume is already {}'.format(previous_volume))
+                return
+            # Assume the TV takes it until the subscription says otherwise
+            self.current_volume = volume_to_set
+
+        self.lgtv_call('setVolume', 'Volume changed from {} to {}'.format(previous_volume, volume_to_set), level=volume_to_set)
+
+    def command_type(self, name):
+        """Return the command type of a trigger for metrics, e.g. 'change_volume' for 'c5'."""
+        if name in self.set_volume_controls:
+            return 'set_volume'
+        if name in self.change_volume_controls:
+            return 'change_volume'
+        if name in self.inputs:
+            return 'input'
+        if name in self.apps:
+            return 'app'
+        if name in self.macros:
+            return 'macro'
+        return name
 
     def act(self, client_address, state, name):
         """Given a request, execute the desired action.
@@ -215,25 +484,30 @@ class device_handler(debounce_handler.debounce_handler):
             True if success.
         """
         logging.debug('Name: {}, State: {}, Client {}'.format(name, state, client_address))
-        self.check_volume_status()
+        start = time.time()
+        if name.startswith(self.prefix):
+            name = name[len(self.prefix):]
+        if name not in self.set_volume_controls and name not in self.change_volume_controls:
+            # A volume still being coalesced was asked for first, e.g. "volume 20" then "mute"
+            self.flush_volume()
+        if name in ['volume', 'mute'] or name in self.set_volume_controls or name in self.change_volume_controls:
+            self.check_volume_status()
 
         # TV On/Off
         if name == 'tv' and state is True:
-            lgtv_call('on', 'Turning on...', 'Turned on!', popen=True)
+            self.lgtv_call('on', 'Turning on...', 'Turned on!')
         elif name == 'tv' and state is False:
-            lgtv_call('off', 'Turning off...', 'Turned off!', popen=True)
+            self.lgtv_call('off', 'Turning off...', 'Turned off!')
 
         # Volume controls
         elif (name == 'volume' and state is True) or (name == 'mute' and state is False):
             if self.muted is True:
-                # Volume up is the only I way I know how to unmute
-                lgtv_call('volumeUp')
-                lgtv_call('volumeDown', 'Turned off mute')  # Volume down to maintain same volume level
+                self.run_macro(UNMUTE, after_msg='Turned off mute')
             else:
                 logging.info('Asked to unmute, but already unmuted')
         elif (name == 'volume' and state is False) or (name == 'mute' and state is True):
             if self.muted is False:
-                lgtv_call('mute muted', 'Turned on mute')
+                self.lgtv_call('mute', 'Turned on mute', muted=True)
             else:
                 logging.info('Asked to mute, but already muted')
         elif name in self.set_volume_controls:
@@ -243,34 +517,141 @@ class device_handler(debounce_handler.debounce_handler):
 
         # Playback
         elif name == 'playback' and state is True:
-            lgtv_call('inputMediaPlay', 'Playback set to RESUME')
+            self.lgtv_call('inputMediaPlay', 'Playback set to RESUME')
         elif name == 'playback' and state is False:
-            lgtv_call('inputMediaPause', 'Playback set to PAUSE')
+            self.lgtv_call('inputMediaPause', 'Playback set to PAUSE')
 
         # Inputs
-        elif name in INPUTS.keys() and state is True:
-            lgtv_call('setInput {}'.format(INPUTS[name]), 'Input set to {}'.format(name))
+        elif name in self.inputs and state is True:
+            self.lgtv_call('setInput', 'Input set to {}'.format(name), input_id=self.inputs[name])
             self.last_input = self.current_input
             self.current_input = name
-        elif name in INPUTS.keys() and state is False:
+        elif name in self.inputs and state is False:
             if self.last_input is not None:
-                lgtv_call('setInput {}'.format(INPUTS[self.last_input]), 'Turning off {}, switching to last input {}'.format(name, self.last_input))
-                self.last_input = self.current_input
-                self.current_input = self.last_input
+                switch = lgtv.LGTVMacro([{'command': 'setInput', 'input_id': self.inputs[self.last_input]}])
+                self.run_macro(switch, 'Turning off {}, switching to last input {}'.format(name, self.last_input))
+                self.last_input, self.current_input = self.current_input, self.last_input
             else:
                 # TODO: Send notifications to TV for certain errors
                 logging.error('Can\'t turn off {} because no last input'.format(name))
 
         # Apps
-        elif name in APPS.keys():
+        elif name in self.apps:
             if state is True:
-                lgtv_call('startApp {}'.format(APPS[name]), 'Started {}'.format(name))
+                self.lgtv_call('startApp', 'Started {}'.format(name), appid=self.apps[name])
             else:
-                lgtv_call('closeApp {}'.format(APPS[name]), 'Closed {}'.format(name))
+                self.lgtv_call('closeApp', 'Closed {}'.format(name), appid=self.apps[name])
 
+        # Macros
+        elif name in self.macros:
+            macro = self.macros[name][0 if state is True else 1]
+            if macro is not None:
+                self.run_macro(macro, 'Running {} ({})'.format(name, 'on' if state is True else 'off'), 'Ran {}'.format(name))
+            else:
+                logging.info('{} has no steps for turning it {}'.format(name, 'on' if state is True else 'off'))
+
+        ACT_SECONDS.observe(time.time() - start, command=self.command_type(name), state='on' if state else 'off')
         return True
 
 
+class trigger_watcher(object):
+    """Keeps the fauxmo devices in step with the handlers' triggers, reloading the --config file when it changes.
+
+    A reload only creates devices for new triggers and closes the devices of
+    removed ones. Devices whose trigger stays keep their port and serial, so
+    the Echo doesn't need to discover them again.
+    """
+    def __init__(self, config_path, handlers, args, listener, poller, http_server=None, executor=None):
+        self.config_path = config_path
+        self.handlers = handlers
+        self.args = args
+        self.listener = listener
+        self.poller = poller
+        self.http_server = http_server
+        self.executor = executor
+        self.devices = {}  # Trigger name to its fauxmo device
+        self.config = None
+        self.config_mtime = None
+
+    def start(self):
+        """Register the triggers of the current configuration, then check the file for changes on the loop"""
+        self.check()
+        if not self.devices:
+            logging.warning('No triggers registered')
+
+    def check(self):
+        if self.config_path is None:
+            if self.config_mtime is None:
+                self.config_mtime = 0
+                self.sync(load_config())
+            return
+        try:
+            self.reload()
+        except Exception:
+            logging.exception('Reloading {} failed'.format(self.config_path))
+        finally:
+            # Whatever happened, look at the file again later
+            self.poller.call_later(CONFIG_CHECK_SECONDS, self.check)
+
+    def reload(self):
+        """Sync to the --config file if it changed since the last check"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except OSError as e:
+            mtime = None
+            if self.config_mtime != -1:
+                logging.error('Can\'t read {}, keeping the current triggers: {}'.format(self.config_path, e))
+                self.config_mtime = -1  # Only say so once
+        if mtime is not None and mtime != self.config_mtime:
+            self.config_mtime = mtime
+            try:
+                config = load_config(self.config_path)
+            except (IOError, ValueError) as e:
+                logging.error('Bad configuration in {}, keeping the current triggers: {}'.format(self.config_path, e))
+            else:
+                self.sync(config)
+
+    def resync(self):
+        """Rebuild the triggers with the current configuration, e.g. after apps changed on the TV"""
+        if self.config is not None:
+            self.sync(self.config)
+
+    def sync(self, config):
+        """Apply config to every handler and create/close devices for the triggers that came/went."""
+        self.config = config
+        wanted = {}  # Trigger name to (handler, port)
+        for handler in self.handlers:
+            handler.configure(config)
+            handler.init_triggers(self.args)
+            for trigger, port in handler.triggers.items():
+                wanted[trigger] = (handler, port)
+
+        removed = [trigger for trigger in self.devices if trigger not in wanted]
+        for trigger in removed:
+            self.devices.pop(trigger).close()
+
+        # Without a shared server every device has a port of its own, and ports already taken stay taken
+        used_ports = set(device.port for device in self.devices.values())
+        added = []
+        for trigger in sorted(wanted):
+            if trigger in self.devices:
+                continue
+            handler, port = wanted[trigger]
+            if self.http_server is None:
+                while port in used_ports:
+                    port += 1
+                used_ports.add(port)
+            try:
+                self.devices[trigger] = fauxmo.fauxmo(trigger, self.listener, self.poller, None, port, handler,
+                                                      http_server=self.http_server, executor=self.executor)
+            except (socket.error, ValueError) as e:
+                logging.error('Can\'t register trigger {} on port {}: {}'.format(trigger, port, e))
+                continue
+            added.append(trigger)
+        if added or removed:
+            logging.info('Triggers added: {}, removed: {}'.format(added, removed))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--all", help="register all triggers", action="store_true")
@@ -281,29 +662,81 @@ if __name__ == '__main__':
     parser.add_argument("--set_volume_start", type=int, help="start of set volume range", default=0)
     parser.add_argument("--set_volume_end", type=int, help="end of set volume range", default=MAX_VOLUME)
     parser.add_argument("--change_volume", help="register change volume triggers", action="store_true")
+    parser.add_argument("--macros", help="register macro triggers", action="store_true")
+    parser.add_argument("--workers", type=int, help="threads running TV commands after the Echo is answered, 0 to answer only once the command is done", default=2)
+    parser.add_argument("--single_port", type=int, help="serve every trigger from this one port instead of a port per trigger", default=None)
+    parser.add_argument("--tvs", help="comma separated ids of the TVs to control (see \"python lgtv.py auth\"), triggers are prefixed with the id when there are several", default=lgtv.LGTVRegistry.DEFAULT_TV)
+    parser.add_argument("--heartbeat", type=float, help="seconds between pings keeping the TV connections alive, 0 to connect on the first command instead", default=HEARTBEAT_SECONDS)
+    parser.add_argument("--idle_timeout", type=int, help="with --heartbeat 0, seconds before an unused TV connection is closed, 0 to keep it open", default=IDLE_TIMEOUT)
+    parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics at /metrics on this port", default=None)
+    parser.add_argument("--auto_apps", help="also register a trigger for every app installed on the TV, named after its title", action="store_true")
+    parser.add_argument("--config", help="JSON file of apps, inputs, macros and volume ranges (see load_config), reloaded when it changes", default=None)
     args = parser.parse_args()
 
+    # Only paired TVs can be controlled, say so now rather than on the first command
+    registry = lgtv.LGTVRegistry()
+    tv_ids = args.tvs.split(',')
+    unpaired = [tv_id for tv_id in tv_ids if tv_id not in registry.tv_ids()]
+    if unpaired:
+        parser.error('TV {} not paired, run "python lgtv.py auth" first (paired: {})'.format(
+            ', '.join(unpaired), ', '.join(registry.tv_ids()) or 'none'))
+
     # TODO: Use newer fauxmo version (python 3)
     # Startup the fauxmo server
     fauxmo.DEBUG = True if LOG_LEVEL == logging.DEBUG else False
     poller = fauxmo.poller()
-    listener = fauxmo.upnp_broadcast_responder()
+    listener = fauxmo.upnp_broadcast_responder(poller)
     listener.init_socket()
     poller.add(listener)
 
-    # Register the device callback as a fauxmo handler
-    device_handler = device_handler()
-    device_handler.init_triggers(args)
-    for trigger, port in device_handler.triggers.items():
-        fauxmo.fauxmo(trigger, listener, poller, None, port, device_handler)
+    # With --single_port, every trigger shares one listening socket and is told apart by the path in its URLs
+    http_server = None
+    if args.single_port is not None:
+        http_server = fauxmo.upnp_http_server(poller, None, args.single_port)
+
+    if args.metrics_port is not None:
+        metrics_server = fauxmo.upnp_http_server(poller, None, args.metrics_port)
+        metrics_server.add_device(metrics.metrics_endpoint(), default=True)
+
+    # Acknowledge the Echo right away and run TV commands on worker threads, one command at a time per TV
+    executor = fauxmo.keyed_executor(args.workers) if args.workers > 0 else None
+
+    # TVs that moved to a new address are found again by uuid in the discovery cache, kept fresh in the background
+    discovery = lgtv.LGTVDiscoveryCache()
+    if any(registry.load(tv_id).get('uuid') for tv_id in tv_ids):
+        discovery.start_refresh()  # Otherwise there is nothing to look up, don't keep searching the network
+    # One paired connection per TV, shared by the handlers
+    pool = lgtv.LGTVPool(registry, idle_timeout=args.idle_timeout, handshake_timeout=HANDSHAKE_TIMEOUT, discovery=discovery)
+
+    # Register a device callback per TV as a fauxmo handler, for each trigger in the configuration
+    handlers = [device_handler(pool, tv_id, tv_id + ' ' if len(tv_ids) > 1 else '', i * TV_PORT_STRIDE,
+                               app_index=lgtv.LGTVAppIndex(pool.registry.app_index_file(tv_id)) if args.auto_apps else None,
+                               executor=executor)
+                for i, tv_id in enumerate(tv_ids)]
+    watcher = trigger_watcher(args.config, handlers, args, listener, poller, http_server, executor)
+    watcher.start()
+
+    if args.auto_apps:
+        for handler in handlers:
+            # Triggers follow apps being installed and removed, the index is updated on the connection's thread
+            handler.app_index.add_listener(lambda: poller.call_soon_threadsafe(watcher.resync))
+
+    # Subscribe to volume (and app) events on every new connection, not just once a command needs one
+    handlers_by_tv = dict((handler.tv_id, handler) for handler in handlers)
+    pool.add_connect_listener(lambda tv_id, client: handlers_by_tv[tv_id].use_client(client))
+    if args.heartbeat > 0:
+        # Pair now and reconnect whenever a connection drops, e.g. after "turn off", so no command waits for a handshake
+        pool.keep_alive(tv_ids, args.heartbeat)
+    elif args.auto_apps:
+        for handler in handlers:
+            # Connect now instead of on the first command, to fill the index
+            connect = threading.Thread(target=handler.get_client)
+            connect.daemon = True
+            connect.start()
 
     # Loop and poll for incoming Alexa device requests
     logging.debug('Entering fauxmo polling loop')
-    while True:
-        try:
-            # TODO: Sometimes no response after turn off
-            # Have to manually run command or turn TV on
-            poller.poll(100)
-        except Exception, e:
-            logging.critical('Critical exception: {}'.format(e))
-            break
+    try:
+        poller.run_forever()
+    except Exception, e:
+        logging.critical('Critical exception: {}'.format(e))
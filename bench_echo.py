@@ -0,0 +1,216 @@
+"""bench_echo.py: Load test a local fauxmo/alexa-tv instance by simulating Echo devices
+
+Each simulated Echo sends an M-SEARCH for urn:Belkin:device:**, fetches
+setup.xml from every LOCATION it hears about, then posts SetBinaryState
+requests to each device it found. All Echos run each phase at the same
+time, and the tool reports discovery completion time, request throughput
+and p50/p95/p99 latency per phase.
+
+Usage:
+- Against an instance that is already running on this host:
+  python bench_echo.py --echos 3 --expected 130
+- Against throwaway fauxmo servers with 10, 50 and 130 triggers:
+  python bench_echo.py --spawn 10,50,130
+
+Don't point it at alexa-tv.py while it drives a real TV unless you want the
+TV to get every command.
+"""
+import argparse
+import httplib
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+import bench_stats
+
+SEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+          'HOST: 239.255.255.250:1900\r\n'
+          'MAN: "ssdp:discover"\r\n'
+          'MX: %d\r\n'
+          'ST: urn:Belkin:device:**\r\n'
+          '\r\n')
+SOAP_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+             '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+             's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+             '<s:Body><u:SetBinaryState xmlns:u="urn:Belkin:service:basicevent:1">'
+             '<BinaryState>%d</BinaryState>'
+             '</u:SetBinaryState></s:Body></s:Envelope>')
+SOAP_HEADERS = {
+    'SOAPACTION': '"urn:Belkin:service:basicevent:1#SetBinaryState"',
+    'Content-Type': 'text/xml; charset="utf-8"',
+}
+# Trigger names like alexa-tv.py registers for a TV, --serve prefixes them with a TV id per TV
+TRIGGERS = (['tv', 'volume', 'mute', 'playback', 'netflix', 'youtube', 'amazon', 'gallery', 'chromecast', 'playstation', 'pc']
+            + [str(i) for i in range(0, 101)] + ['c{}'.format(i) for i in range(1, 11)])
+TV_IDS = ['bedroom', 'living room', 'kitchen', 'office']
+LOCATION_PATTERN = re.compile(r'^LOCATION:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+CONTROL_URL_PATTERN = re.compile(r'<controlURL>(.*?)</controlURL>')
+
+
+class echo(object):
+    """One simulated Echo device."""
+    def __init__(self, args):
+        self.args = args
+        self.locations = set()
+        self.discovery_time = None  # Seconds until the last new device was heard of
+        self.control_urls = []
+        self.setup_latencies = []
+        self.action_latencies = []
+        self.setup_errors = 0
+        self.action_errors = 0
+
+    def discover(self):
+        """Send one M-SEARCH and collect LOCATIONs until MX + 1 seconds pass or --expected devices answered."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time.time()
+        sock.sendto(SEARCH % self.args.mx, (self.args.host, self.args.ssdp_port))
+        deadline = start + self.args.mx + 1
+        while time.time() < deadline and len(self.locations) < (self.args.expected or sys.maxint):
+            sock.settimeout(max(0.01, deadline - time.time()))
+            try:
+                data, sender = sock.recvfrom(2048)
+            except socket.timeout:
+                break
+            location = LOCATION_PATTERN.search(data)
+            if location and location.group(1) not in self.locations:
+                self.locations.add(location.group(1))
+                self.discovery_time = time.time() - start
+        sock.close()
+
+    def http(self, method, url, latencies, body=None, headers={}):
+        """Make one request on a new connection like the Echo does, returns the body or None on failure."""
+        parsed = urlparse.urlparse(url)
+        start = time.time()
+        try:
+            connection = httplib.HTTPConnection(parsed.hostname, parsed.port, timeout=self.args.timeout)
+            connection.request(method, parsed.path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+        except (socket.error, httplib.HTTPException):
+            return None
+        if response.status != 200:
+            return None
+        latencies.append(time.time() - start)
+        return data
+
+    def fetch_setup(self):
+        for location in sorted(self.locations):
+            data = self.http('GET', location, self.setup_latencies)
+            if data is None:
+                self.setup_errors += 1
+            else:
+                control_url = CONTROL_URL_PATTERN.search(data)
+                self.control_urls.append(urlparse.urljoin(location, control_url.group(1) if control_url else '/upnp/control/basicevent1'))
+
+    def switch(self):
+        for i in range(self.args.actions):
+            for control_url in self.control_urls:
+                if self.http('POST', control_url, self.action_latencies, SOAP_BODY % ((i + 1) % 2), SOAP_HEADERS) is None:
+                    self.action_errors += 1
+
+
+def run_phase(echos, phase):
+    """Run one phase on every Echo at the same time, returns the elapsed seconds."""
+    start = time.time()
+    threads = [threading.Thread(target=getattr(one_echo, phase)) for one_echo in echos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def benchmark(args):
+    echos = [echo(args) for i in range(args.echos)]
+    run_phase(echos, 'discover')
+    setup_elapsed = run_phase(echos, 'fetch_setup')
+    action_elapsed = run_phase(echos, 'switch')
+
+    found = [len(one_echo.locations) for one_echo in echos]
+    discovery_times = [one_echo.discovery_time for one_echo in echos if one_echo.discovery_time is not None]
+    print 'echos={} found min={} max={}{}'.format(args.echos, min(found), max(found),
+                                                   ' expected={}'.format(args.expected) if args.expected else '')
+    print bench_stats.summarize('discovery complete', discovery_times)
+    print bench_stats.summarize('setup.xml', sum([one_echo.setup_latencies for one_echo in echos], []), setup_elapsed,
+                                sum([one_echo.setup_errors for one_echo in echos]))
+    print bench_stats.summarize('SetBinaryState', sum([one_echo.action_latencies for one_echo in echos], []), action_elapsed,
+                                sum([one_echo.action_errors for one_echo in echos]))
+
+
+class bench_handler(object):
+    """Quiet fauxmo action handler for --serve."""
+    def on(self, client_address, name):
+        return True
+
+    def off(self, client_address, name):
+        return True
+
+
+def trigger_names(count):
+    """count trigger names, every trigger of one TV before the next TV's"""
+    names = ['{} {}'.format(tv_id, trigger) for tv_id in TV_IDS for trigger in TRIGGERS]
+    if count > len(names):
+        raise ValueError('At most {} triggers'.format(len(names)))
+    return names[:count]
+
+
+def serve(args):
+    """Run a fauxmo server with --serve triggers that do nothing."""
+    import fauxmo
+    poller = fauxmo.poller()
+    listener = fauxmo.upnp_broadcast_responder(poller)
+    listener.init_socket()
+    poller.add(listener)
+    http_server = fauxmo.upnp_http_server(poller, args.host, 0) if args.single_port else None
+    executor = fauxmo.keyed_executor(args.workers) if args.workers > 0 else None
+    handler = bench_handler()
+    for name in trigger_names(args.serve):
+        fauxmo.fauxmo(name, listener, poller, args.host, 0, handler, http_server=http_server, executor=executor)
+    print 'ready'
+    sys.stdout.flush()
+    poller.run_forever()
+
+
+def spawn(args):
+    """Benchmark a freshly started fauxmo server for each trigger count in --spawn."""
+    for count in [int(x) for x in args.spawn.split(',')]:
+        command = [sys.executable, __file__, '--serve', str(count), '--host', args.host, '--workers', str(args.workers)]
+        if args.single_port:
+            command.append('--single_port')
+        server = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            server.stdout.readline()  # Wait for 'ready'
+            args.expected = count
+            print '--- triggers={}'.format(count)
+            benchmark(args)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address of the fauxmo instance", default='127.0.0.1')
+    parser.add_argument("--ssdp_port", type=int, help="port the instance listens for M-SEARCH on", default=1900)
+    parser.add_argument("--echos", type=int, help="number of simulated Echo devices", default=3)
+    parser.add_argument("--mx", type=int, help="MX value of the M-SEARCH", default=2)
+    parser.add_argument("--expected", type=int, help="stop discovery once this many devices answered", default=None)
+    parser.add_argument("--actions", type=int, help="SetBinaryState requests per device per Echo", default=1)
+    parser.add_argument("--timeout", type=float, help="HTTP timeout in seconds", default=5)
+    parser.add_argument("--spawn", help="comma separated trigger counts to start throwaway fauxmo servers for")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--single_port", help="spawned servers serve every trigger from one port", action="store_true")
+    parser.add_argument("--workers", type=int, help="worker threads of spawned servers", default=2)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args)
+    elif args.spawn:
+        spawn(args)
+    else:
+        benchmark(args)
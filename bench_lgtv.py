@@ -0,0 +1,125 @@
+"""bench_lgtv.py: Measure LGTVClient throughput and round trip times against a fake TV
+
+Drives the real LGTVClient code against fake_lgtv.py and reports, with
+p50/p95/p99 latencies:
+- connect + register handshake time with a stored client-key
+- commands/sec and round trip times with at most --window commands in flight,
+  for each window size (1 is one command at a time)
+
+The fake TV runs in this process unless --port is given, in which case a
+fake_lgtv.py started separately is used (it should accept --client_key).
+
+Usage:
+- python bench_lgtv.py --commands 1000 --window 1,8,32 --delay 5 --jitter 2
+- python fake_lgtv.py --port 3001 --client_key bench & python bench_lgtv.py --port 3001
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import bench_stats
+import fake_lgtv
+import lgtv
+
+CLIENT_KEY = 'bench'
+
+
+def connect(settings_file, port):
+    """Connect and pair a resident LGTVClient, returns it with the seconds it took."""
+    start = time.time()
+    client = lgtv.LGTVClient(persistent=True, port=port, settings_file=settings_file)
+    client.connect()
+    if not client.wait_for_handshake(5):
+        raise Exception('Handshake with the fake TV failed')
+    return client, time.time() - start
+
+
+def run_window(client, commands, window, timeout):
+    """Send commands setVolume requests with at most window in flight.
+
+    Returns:
+        (round trip times, elapsed seconds, number of requests left unanswered)
+    """
+    slots = threading.Semaphore(window)
+    latencies = []
+    requests = []
+
+    def done(start):
+        def callback(response):
+            if response.get('type') != 'error':
+                latencies.append(time.time() - start)
+            slots.release()
+        return callback
+
+    started = time.time()
+    for i in range(commands):
+        # Dropped replies never free their slot, so don't wait forever for one
+        if not acquire(slots, timeout):
+            break
+        requests.append(client.setVolume(i % 100, callback=done(time.time())))
+    for request in requests:
+        request.wait(timeout)
+    elapsed = time.time() - started
+    return latencies, elapsed, len([request for request in requests if not request.done()])
+
+
+def acquire(semaphore, timeout):
+    """Semaphore.acquire with a timeout, which Python 2 doesn't have."""
+    deadline = time.time() + timeout
+    while not semaphore.acquire(False):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.0005)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address of the fake TV", default='127.0.0.1')
+    parser.add_argument("--port", type=int, help="port of a fake TV that is already running, by default one is started in this process")
+    parser.add_argument("--commands", type=int, help="commands per window size", default=500)
+    parser.add_argument("--window", help="comma separated numbers of commands in flight", default='1,8,32')
+    parser.add_argument("--connects", type=int, help="number of connect + handshake measurements", default=5)
+    parser.add_argument("--timeout", type=float, help="seconds to wait for a reply before counting it as dropped", default=2)
+    parser.add_argument("--delay", type=float, help="milliseconds the in-process fake TV waits before each response", default=0)
+    parser.add_argument("--jitter", type=float, help="random +/- milliseconds added to the delay", default=0)
+    parser.add_argument("--drop", type=float, help="probability of the in-process fake TV never answering", default=0)
+    args = parser.parse_args()
+
+    port = args.port
+    server = None
+    if port is None:
+        options = fake_lgtv.parse_options(['--host', args.host, '--port', '0', '--client_key', CLIENT_KEY,
+                                           '--delay', str(args.delay), '--jitter', str(args.jitter), '--drop', str(args.drop)])
+        server = fake_lgtv.serve(options)
+        port = server.server_port
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # Settings of our own so ~/.lgtv.json is left alone
+    handle, settings_file = tempfile.mkstemp(suffix='.json')
+    os.write(handle, json.dumps({'hostname': args.host, 'client-key': CLIENT_KEY, 'ip': args.host, 'mac-address': '00:00:00:00:00:00'}))
+    os.close(handle)
+    try:
+        connect_times = []
+        for i in range(args.connects):
+            client, seconds = connect(settings_file, port)
+            connect_times.append(seconds)
+            client.close()
+        print bench_stats.summarize('connect + handshake', connect_times)
+
+        client, seconds = connect(settings_file, port)
+        for window in [int(x) for x in args.window.split(',')]:
+            latencies, elapsed, dropped = run_window(client, args.commands, window, args.timeout)
+            print bench_stats.summarize('window={}'.format(window), latencies, elapsed, dropped)
+        client.close()
+    finally:
+        os.remove(settings_file)
+        if server is not None:
+            # The websocket manager thread isn't a daemon, stop it or we never exit
+            server.shutdown()
+            server.server_close()
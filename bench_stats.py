@@ -0,0 +1,32 @@
+"""bench_stats.py: Latency summaries shared by the benchmark tools"""
+
+
+def percentile(samples, pct):
+    """Return the nearest-rank percentile of samples.
+
+    Arguments:
+        samples (list): measurements, need not be sorted
+        pct (float):    percentile between 0 and 100
+
+    Returns:
+        The measurement at that rank, or None if there are no samples
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summarize(name, samples, elapsed=None, errors=0):
+    """Format count, throughput and p50/p95/p99/max latency of samples (in seconds) as one line."""
+    line = '{:<24} n={:<6}'.format(name, len(samples))
+    if errors:
+        line += ' errors={}'.format(errors)
+    if elapsed:
+        line += ' rate={:.1f}/s'.format(len(samples) / elapsed)
+    if samples:
+        line += ' p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms max={:.1f}ms'.format(
+            percentile(samples, 50) * 1000, percentile(samples, 95) * 1000,
+            percentile(samples, 99) * 1000, max(samples) * 1000)
+    return line
@@ -1,38 +1,58 @@
+import collections
+import threading
 import time
 
+import metrics
+
+DEBOUNCE_DROPS = metrics.counter('debounce_drops_total', 'Commands ignored as repeats from another Echo', ['trigger'])
+
 class debounce_handler(object):
     """Use this handler to keep multiple Amazon Echo devices from reacting to
        the same voice command.
     """
     DEBOUNCE_SECONDS = 0.3
+    MAX_DEBOUNCE_KEYS = 256  # Bound on remembered commands, the oldest are forgotten first
 
     def __init__(self):
-        self.lastEcho = time.time()
+        # (name, state) to when that command was last acted on, oldest first
+        self.recent_commands = collections.OrderedDict()
+        self.debounce_lock = threading.Lock()
 
     def on(self, client_address, name):
-        if self.debounce():
+        if self.debounce(name, True):
             return True
         return self.act(client_address, True, name)
 
     def off(self, client_address, name):
-        if self.debounce():
+        if self.debounce(name, False):
             return True
         return self.act(client_address, False, name)
 
     def act(self, client_address, state):
         pass
 
-    def debounce(self):
+    def debounce(self, name=None, state=None):
         """If multiple Echos are present, the one most likely to respond first
            is the one that can best hear the speaker... which is the closest one.
            Adding a refractory period to handlers keeps us from worrying about
            one Echo overhearing a command meant for another one.
-        """
-        if (time.time() - self.lastEcho) < self.DEBOUNCE_SECONDS:
-            return True
-
-        self.lastEcho = time.time()
-        return False
-
-
 
+           The refractory period is kept per command (trigger name and state),
+           so a different command right after this one still goes through.
+        """
+        key = (name, state)
+        now = time.time()
+        with self.debounce_lock:
+            # Entries are in the order they were added, so expired ones are at the front
+            while self.recent_commands:
+                oldest_key, oldest_time = next(self.recent_commands.iteritems())
+                if (now - oldest_time) < self.DEBOUNCE_SECONDS and len(self.recent_commands) < self.MAX_DEBOUNCE_KEYS:
+                    break
+                del self.recent_commands[oldest_key]
+
+            if key in self.recent_commands:
+                DEBOUNCE_DROPS.inc(trigger=name)
+                return True
+
+            self.recent_commands[key] = now
+            return False
@@ -0,0 +1,251 @@
+"""fake_lgtv.py: Local stand-in for a WebOS TV, for testing and benchmarking LGTVClient
+
+Serves the WebOS WebSocket API: the register pairing flow of lgtv.hello_data
+and the SSAP URIs LGTVClient uses (audio, launcher, applicationManager, tv,
+media.controls, system...). The TV state (volume, mute, input, apps) lives in
+memory. Responses can be delayed or dropped, and subscribers to
+ssap://audio/getVolume can be sent volume change events as if someone was
+using the remote.
+
+Usage:
+- python fake_lgtv.py --port 3000 --delay 20 --jitter 10 --drop 0.01 --event_interval 5
+- Pair with "python lgtv.py auth 127.0.0.1", or start with --client_key to accept a stored key
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import uuid
+from wsgiref.simple_server import make_server
+
+from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.websocket import WebSocket
+
+
+class fake_tv_state(object):
+    """What the fake TV is currently doing, shared by every connection."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.volume = 10
+        self.muted = False
+        self.input_id = 'HDMI_1'
+        self.foreground_app = 'com.webos.app.livetv'
+        self.channel = {'channelId': '1_1', 'channelNumber': '1', 'channelName': 'Fake One'}
+        self.apps = [
+            {'id': 'netflix', 'title': 'Netflix'},
+            {'id': 'youtube.leanback.v4', 'title': 'YouTube'},
+            {'id': 'amazon', 'title': 'Prime Video'},
+            {'id': 'com.webos.app.igallery', 'title': 'Gallery'},
+        ]
+        self.inputs = [{'id': 'HDMI_{}'.format(i), 'label': 'HDMI{}'.format(i), 'appId': 'com.webos.app.hdmi{}'.format(i)} for i in range(1, 5)]
+        self.client_keys = set()
+
+    def volume_status(self):
+        return {'scenario': 'mastervolume_tv_speaker', 'volume': self.volume, 'muted': self.muted}
+
+
+class fake_tv_socket(WebSocket):
+    """One client connection to the fake TV."""
+    # Set by serve()
+    options = None
+    state = None
+    subscribers = set()  # fake_tv_socket instances subscribed to volume events, with their request ids
+    subscribers_lock = threading.Lock()
+
+    def opened(self):
+        self.send_lock = threading.Lock()
+        self.paired = False
+        self.volume_subscriptions = []
+
+    def closed(self, code, reason=None):
+        with self.subscribers_lock:
+            self.subscribers.discard(self)
+
+    def reply(self, message, delay=True):
+        """Send message after the configured delay, or drop it with the configured probability."""
+        if delay and random.random() < self.options.drop:
+            logging.debug('Dropping reply {}'.format(message.get('id')))
+            return
+        seconds = (self.options.delay + random.uniform(-self.options.jitter, self.options.jitter)) / 1000.0 if delay else 0
+        if seconds > 0:
+            timer = threading.Timer(seconds, self.send_message, [message])
+            timer.daemon = True
+            timer.start()
+        else:
+            self.send_message(message)
+
+    def send_message(self, message):
+        if self.terminated:
+            return
+        with self.send_lock:
+            try:
+                self.send(json.dumps(message))
+            except Exception as e:
+                logging.debug('Reply failed: {}'.format(e))
+
+    def received_message(self, raw):
+        message = json.loads(str(raw))
+        payload = message.get('payload') or {}
+        if isinstance(payload, basestring):  # LGTVClient sends its payloads JSON encoded
+            payload = json.loads(payload) if payload else {}
+
+        if message.get('type') == 'register':
+            self.register(message, payload)
+        elif not self.paired:
+            self.reply({'type': 'error', 'id': message.get('id'), 'error': '401 insufficient permissions (not registered)', 'payload': {}})
+        else:
+            self.request(message, payload)
+
+    def register(self, message, payload):
+        key = payload.get('client-key')
+        if key and (key in self.state.client_keys or self.options.accept_any_key):
+            self.paired = True
+            self.reply({'type': 'registered', 'id': message['id'], 'payload': {'client-key': key}})
+            return
+
+        # Unknown client: prompt, then "accept" on the TV after pair_delay
+        self.reply({'type': 'response', 'id': message['id'], 'payload': {'pairingType': 'PROMPT', 'returnValue': True}}, delay=False)
+        new_key = uuid.uuid4().hex
+
+        def accept():
+            self.state.client_keys.add(new_key)
+            self.paired = True
+            self.send_message({'type': 'registered', 'id': message['id'], 'payload': {'client-key': new_key}})
+        timer = threading.Timer(self.options.pair_delay, accept)
+        timer.daemon = True
+        timer.start()
+
+    def request(self, message, payload):
+        uri = message.get('uri', '')
+        response = {'type': 'response', 'id': message.get('id'), 'payload': {'returnValue': True}}
+        result = response['payload']
+        state = self.state
+        changed_volume = False
+
+        with state.lock:
+            if uri == 'ssap://audio/getVolume':
+                result.update(state.volume_status())
+                if message.get('type') == 'subscribe':
+                    result['subscribed'] = True
+                    with self.subscribers_lock:
+                        self.volume_subscriptions.append(message.get('id'))
+                        self.subscribers.add(self)
+            elif uri == 'ssap://audio/getStatus':
+                result.update(state.volume_status())
+            elif uri == 'ssap://audio/setVolume':
+                state.volume = max(0, min(100, int(payload.get('volume', state.volume))))
+                changed_volume = True
+            elif uri == 'ssap://audio/volumeUp':
+                state.volume = min(100, state.volume + 1)
+                state.muted = False
+                changed_volume = True
+            elif uri == 'ssap://audio/volumeDown':
+                state.volume = max(0, state.volume - 1)
+                state.muted = False
+                changed_volume = True
+            elif uri == 'ssap://audio/setMute':
+                state.muted = bool(payload.get('mute'))
+                changed_volume = True
+            elif uri in ('ssap://system.launcher/launch', 'ssap://com.webos.applicationManager/launch'):
+                state.foreground_app = payload.get('id')
+                result['id'] = state.foreground_app
+            elif uri == 'ssap://system.launcher/close':
+                state.foreground_app = 'com.webos.app.livetv'
+            elif uri == 'ssap://system.launcher/open':
+                state.foreground_app = 'com.webos.app.browser'
+            elif uri == 'ssap://com.webos.applicationManager/listLaunchPoints':
+                result['launchPoints'] = state.apps
+                if message.get('type') == 'subscribe':
+                    result['subscribed'] = True
+            elif uri == 'ssap://tv/getExternalInputList':
+                result['devices'] = state.inputs
+            elif uri == 'ssap://tv/switchInput':
+                state.input_id = payload.get('inputId')
+            elif uri in ('ssap://tv/getCurrentChannel', 'ssap://tv/openChannel', 'ssap://tv/channelUp', 'ssap://tv/channelDown'):
+                result.update(state.channel)
+            elif uri == 'ssap://tv/getChannelList':
+                result['channelList'] = [state.channel]
+            elif uri.startswith('ssap://media.controls/') or uri.startswith('ssap://com.webos.service.tv.display/'):
+                pass
+            elif uri == 'ssap://system.notifications/createToast':
+                result['toastId'] = uuid.uuid4().hex
+            elif uri == 'ssap://system/turnOff':
+                self.reply(response)
+                self.close(1000, 'Turning off')
+                return
+            elif uri == 'ssap://api/getServiceList':
+                result['services'] = [{'name': name, 'version': 1} for name in ('audio', 'media.controls', 'system', 'system.launcher', 'tv')]
+            elif uri == 'ssap://com.webos.service.update/getCurrentSWInformation':
+                result.update({'product_name': 'webOSTV 3.0', 'model_name': 'FAKE', 'device_id': 'fa:ke:00:00:00:00'})
+            else:
+                response = {'type': 'error', 'id': message.get('id'), 'error': '404 no such service or method', 'payload': {}}
+
+        self.reply(response)
+        if changed_volume:
+            notify_volume_subscribers()
+
+
+def notify_volume_subscribers():
+    """Send the current volume status to every getVolume subscriber."""
+    with fake_tv_socket.state.lock:
+        status = fake_tv_socket.state.volume_status()
+    status['changed'] = ['volume', 'muted']
+    with fake_tv_socket.subscribers_lock:
+        subscribers = list(fake_tv_socket.subscribers)
+    for subscriber in subscribers:
+        for request_id in subscriber.volume_subscriptions:
+            subscriber.reply({'type': 'response', 'id': request_id, 'payload': dict(status)})
+
+
+def remote_control_events(interval):
+    """Nudge the volume every interval seconds, as if the remote was being used."""
+    state = fake_tv_socket.state
+    with state.lock:
+        state.volume = max(0, min(100, state.volume + random.choice([-1, 1])))
+    notify_volume_subscribers()
+    timer = threading.Timer(interval, remote_control_events, [interval])
+    timer.daemon = True
+    timer.start()
+
+
+def serve(options):
+    """Build the fake TV server for options, returns it without serving."""
+    fake_tv_socket.options = options
+    fake_tv_socket.state = fake_tv_state()
+    if options.client_key:
+        fake_tv_socket.state.client_keys.add(options.client_key)
+
+    server = make_server(options.host, options.port, server_class=WSGIServer,
+                         handler_class=WebSocketWSGIRequestHandler,
+                         app=WebSocketWSGIApplication(handler_cls=fake_tv_socket))
+    server.initialize_websockets_manager()
+    if options.event_interval:
+        remote_control_events(options.event_interval)
+    return server
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address to listen on", default='127.0.0.1')
+    parser.add_argument("--port", type=int, help="port to listen on", default=3000)
+    parser.add_argument("--delay", type=float, help="milliseconds before each response", default=0)
+    parser.add_argument("--jitter", type=float, help="random +/- milliseconds added to the delay", default=0)
+    parser.add_argument("--drop", type=float, help="probability of never answering a request", default=0)
+    parser.add_argument("--event_interval", type=float, help="seconds between volume change events to subscribers, 0 for none", default=0)
+    parser.add_argument("--pair_delay", type=float, help="seconds until a pairing prompt is accepted", default=1)
+    parser.add_argument("--client_key", help="client-key to accept without a pairing prompt")
+    parser.add_argument("--accept_any_key", help="accept any client-key without a pairing prompt", action="store_true")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+    options = parse_options()
+    server = serve(options)
+    logging.info('Fake WebOS TV listening on {}:{}'.format(options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
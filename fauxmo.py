@@ -25,19 +25,29 @@ THE SOFTWARE.
 """
 
 # For a complete discussion, see http://www.makermusings.com
-# TODO(semartin): investigate time.sleep usage in here...
 
+import collections
 import email.utils
+import errno
+import fcntl
+import hashlib
+import heapq
+import os
+import Queue
+import re
 import requests
 import select
 import socket
 import struct
 import sys
+import threading
 import time
 import urllib
 import uuid
 import logging
 
+import metrics
+
 # This XML is the minimum needed to define one of our virtual switches
 # to the Amazon Echo
 
@@ -50,22 +60,92 @@ SETUP_XML = """<?xml version="1.0"?>
     <modelName>Emulated Socket</modelName>
     <modelNumber>3.1415</modelNumber>
     <UDN>uuid:Socket-1_0-%(device_serial)s</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:Belkin:service:basicevent:1</serviceType>
+        <serviceId>urn:Belkin:serviceId:basicevent1</serviceId>
+        <controlURL>%(control_url)s</controlURL>
+      </service>
+    </serviceList>
   </device>
 </root>
 """
 
+CONTROL_PATH = "/upnp/control/basicevent1"
+
+# Responses are pre-rendered as (head, tail) pairs around the DATE value.
+SOAP_RESPONSE = ("HTTP/1.1 200 OK\r\n"
+                 "CONTENT-LENGTH: 0\r\n"
+                 "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
+                 "DATE: ",
+                 "\r\n"
+                 "EXT:\r\n"
+                 "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                 "X-User-Agent: redsonic\r\n"
+                 "CONNECTION: close\r\n"
+                 "\r\n")
+
+NOT_FOUND_RESPONSE = "HTTP/1.1 404 Not Found\r\nCONTENT-LENGTH: 0\r\nCONNECTION: close\r\n\r\n"
+
+SEARCHES_RECEIVED = metrics.counter('fauxmo_ssdp_searches_received_total', 'M-SEARCH requests for WeMo devices received')
+SEARCH_RESPONSES = metrics.counter('fauxmo_ssdp_responses_sent_total', 'Search responses sent, one per device per search answered')
+SETUP_FETCHES = metrics.counter('fauxmo_setup_fetches_total', 'setup.xml requests served', ['trigger'])
+SET_BINARY_STATE = metrics.counter('fauxmo_set_binary_state_total', 'SetBinaryState requests received', ['trigger', 'state'])
+LOOP_BUSY_SECONDS = metrics.histogram('fauxmo_loop_busy_seconds', 'Time each poll() spent on ready sockets, timers and callbacks')
+EXECUTOR_WAIT_SECONDS = metrics.histogram('fauxmo_executor_wait_seconds', 'Time actions were queued before a worker ran them')
+
 
 def dbg(msg):
     logging.debug(msg)
 
 
-# A simple utility class to wait for incoming data to be
-# ready on a socket.
+# The DATE header only has a resolution of one second, so it is
+# formatted at most once per second and shared by every response.
+
+date_cache = {'second': None, 'value': None}
+
+def http_date():
+    now = int(time.time())
+    if date_cache['second'] != now:
+        date_cache['value'] = email.utils.formatdate(timeval=now, localtime=False, usegmt=True)
+        date_cache['second'] = now
+    return date_cache['value']
+
+
+def with_date(response):
+    head, tail = response
+    return head + http_date() + tail
+
+
+# A simple event loop: waits for incoming data to be ready on a
+# socket, runs timers and runs callbacks handed over from other
+# threads. Every socket it serves is non-blocking, so a single thread
+# can serve discovery and all of the virtual devices concurrently.
+
+class timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
 
 class poller:
     def __init__(self):
         self.poller = select.poll()
         self.targets = {}
+        self.timers = []
+        self.timer_count = 0
+        self.ready = collections.deque()
+
+        # Self-pipe so call_soon_threadsafe can wake up a sleeping poll()
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add(self, self.wake_read)
 
     def add(self, target, fileno = None):
         if not fileno:
@@ -73,21 +153,328 @@ class poller:
         self.poller.register(fileno, select.POLLIN)
         self.targets[fileno] = target
 
+    def want_write(self, target, writable, fileno = None):
+        """Also wake target.do_write() while fileno is writable, or stop doing so"""
+        if not fileno:
+            fileno = target.fileno()
+        self.poller.modify(fileno, select.POLLIN | select.POLLOUT if writable else select.POLLIN)
+
     def remove(self, target, fileno = None):
         if not fileno:
             fileno = target.fileno()
         self.poller.unregister(fileno)
         del(self.targets[fileno])
 
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) on the loop after delay seconds, returns a cancellable timer"""
+        one_timer = timer(time.time() + delay, callback, args)
+        self.timer_count += 1
+        heapq.heappush(self.timers, (one_timer.when, self.timer_count, one_timer))
+        return one_timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback(*args) on the loop, may be called from any thread"""
+        self.ready.append((callback, args))
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError:
+            pass  # Pipe full, the loop is going to wake up anyway
+
+    def do_read(self, fileno):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError:
+            pass
+
+    def run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("Exception in loop callback %s" % callback)
+
     def poll(self, timeout = 0):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            next_timer = max(0, (self.timers[0][0] - time.time()) * 1000)
+            if timeout is None or timeout < 0 or next_timer < timeout:
+                timeout = next_timer
+
         ready = self.poller.poll(timeout)
+        start = time.time()
         num = len(ready)
         for one_ready in ready:
             target = self.targets.get(one_ready[0], None)
-            if target:
+            if target and one_ready[1] & select.POLLOUT:
+                target.do_write(one_ready[0])
+                # do_write may have closed the connection
+                target = self.targets.get(one_ready[0], None)
+            if target and one_ready[1] & ~select.POLLOUT:
                 target.do_read(one_ready[0])
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            one_timer = heapq.heappop(self.timers)[2]
+            if not one_timer.cancelled:
+                self.run_callback(one_timer.callback, one_timer.args)
+
+        for i in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            self.run_callback(callback, args)
+        LOOP_BUSY_SECONDS.observe(time.time() - start)
         return num
 
+    def run_forever(self):
+        while True:
+            self.poll(1000)
+
+
+# Runs device actions on worker threads so a slow action never stalls
+# the event loop. Calls submitted with the same key run one at a time,
+# in submission order; calls with different keys run in parallel.
+
+class keyed_executor(object):
+    def __init__(self, workers = 2):
+        self.lock = threading.Lock()
+        self.queues = {}  # Key to the calls still to run, present while the key is queued or running
+        self.ready = Queue.Queue()  # Keys with calls to run
+        for i in range(workers):
+            worker = threading.Thread(target=self.run, name='fauxmo-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, callback, *args):
+        call = (callback, args, time.time())
+        with self.lock:
+            if key in self.queues:
+                self.queues[key].append(call)
+                return
+            self.queues[key] = collections.deque([call])
+        self.ready.put(key)
+
+    def run(self):
+        while True:
+            key = self.ready.get()
+            while True:
+                with self.lock:
+                    if not self.queues[key]:
+                        del(self.queues[key])
+                        break
+                    callback, args, submitted = self.queues[key].popleft()
+                EXECUTOR_WAIT_SECONDS.observe(time.time() - submitted)
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception("Exception in action %s" % callback)
+
+
+# One parsed HTTP request. Header names are lower-cased.
+
+class http_request(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+
+# One accepted HTTP client connection. Incoming bytes are accumulated
+# and framed incrementally (headers, then Content-Length bytes of body),
+# so requests split across TCP segments or pipelined back to back are
+# all dispatched, and no byte is scanned for the end of the headers
+# twice. Replies are queued and flushed as the socket becomes writable.
+
+class http_connection(object):
+    MAX_HEADER_SIZE = 16384
+
+    def __init__(self, server, client_socket, client_address):
+        self.server = server
+        self.socket = client_socket
+        self.client_address = client_address
+        self.buffer = bytearray()
+        self.scan_offset = 0  # Where to resume looking for the end of the headers
+        self.head = None  # Parsed request waiting for the rest of its body
+        self.output = bytearray()
+        self.close_when_flushed = False
+        self.writing = False  # Whether we are waiting for the socket to become writable
+        self.parsing = False
+        self.closed = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def do_read(self, fileno):
+        try:
+            count = self.socket.recv_into(self.server.recv_buffer)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            count = 0  # Reset by peer, drop the connection
+        if not count:
+            self.close()
+            return
+        self.buffer += self.server.recv_view[:count]
+        self.parsing = True
+        try:
+            self.parse()
+        finally:
+            self.parsing = False
+        # Requests pipelined behind one that closes the connection are answered first
+        if self.close_when_flushed and not self.output:
+            self.close()
+
+    def parse(self):
+        while not self.closed:
+            if self.head is None:
+                end = self.buffer.find(b'\r\n\r\n', max(0, self.scan_offset - 3))
+                if end == -1:
+                    self.scan_offset = len(self.buffer)
+                    if self.scan_offset > self.MAX_HEADER_SIZE:
+                        dbg("Request headers from %s too long" % (self.client_address,))
+                        self.close()
+                    return
+                lines = str(self.buffer[:end]).split('\r\n')
+                del self.buffer[:end + 4]
+                self.scan_offset = 0
+                request_line = lines[0].split(' ')
+                if len(request_line) != 3:
+                    dbg("Bad request line from %s: %s" % (self.client_address, lines[0]))
+                    self.close()
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    dbg("Bad Content-Length from %s: %s" % (self.client_address, headers['content-length']))
+                    self.close()
+                    return
+                self.head = (request_line, headers, length)
+
+            request_line, headers, length = self.head
+            if len(self.buffer) < length:
+                return  # Wait for the rest of the body
+            body = str(self.buffer[:length])
+            del self.buffer[:length]
+            self.head = None
+            self.server.handle_request(http_request(request_line[0], request_line[1].split('?')[0], request_line[2], headers, body), self)
+
+    def send(self, data, close = True):
+        """Queue a reply (bytes), the connection is closed once everything queued has been sent"""
+        if not isinstance(data, (str, bytearray)):
+            raise TypeError("Replies must be bytes, not %s" % type(data).__name__)
+        self.output += data
+        self.close_when_flushed = self.close_when_flushed or close
+        self.do_write(self.fileno())
+
+    def do_write(self, fileno):
+        if self.closed:
+            return
+        try:
+            sent = self.socket.send(self.output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+                return
+            sent = 0
+        del self.output[:sent]
+        if self.output:
+            if not self.writing:
+                self.server.poller.want_write(self, True)
+                self.writing = True
+        elif self.close_when_flushed and not self.parsing:
+            self.close()
+        elif self.writing:
+            self.server.poller.want_write(self, False)
+            self.writing = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.poller.remove(self)
+        self.socket.close()
+
+
+# Accepts HTTP connections on one TCP port and dispatches each request
+# to the UPnP device that owns its path. A device can have a server of
+# its own (one port per device) or share one server with every other
+# device, so a large set of virtual devices needs a single socket.
+
+class upnp_http_server(object):
+    def __init__(self, poller, ip_address, port):
+        self.poller = poller
+        self.port = port
+        self.routes = {}
+        self.default_device = None
+        # Every connection reads into this one buffer before framing
+        self.recv_buffer = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buffer)
+
+        if ip_address:
+            self.ip_address = ip_address
+        else:
+            self.ip_address = upnp_device.local_ip_address()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(0)
+        self.socket.bind((self.ip_address, self.port))
+        self.socket.listen(128)
+        if self.port == 0:
+            self.port = self.socket.getsockname()[1]
+        self.poller.add(self)
+
+    def add_device(self, device, default = False):
+        """Route device's paths to it, raises ValueError if another device has one of them"""
+        paths = device.get_paths()
+        for path in paths:
+            if self.routes.get(path, device) is not device:
+                raise ValueError("%s and %s share the path %s" % (self.routes[path].get_name(), device.get_name(), path))
+        for path in paths:
+            self.routes[path] = device
+        if default:
+            self.default_device = device
+
+    def remove_device(self, device):
+        for path in device.get_paths():
+            if self.routes.get(path) is device:
+                del(self.routes[path])
+        if self.default_device is device:
+            self.default_device = None
+
+    def close(self):
+        """Stop accepting connections, the ones already open finish on their own"""
+        self.poller.remove(self)
+        self.socket.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def do_read(self, fileno):
+        try:
+            (client_socket, client_address) = self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return  # Another wakeup already took the connection
+            raise
+        client_socket.setblocking(0)
+        self.poller.add(http_connection(self, client_socket, client_address))
+
+    def handle_request(self, request, connection):
+        device = self.routes.get(request.path, self.default_device)
+        if device is None:
+            dbg("No device for path %s" % request.path)
+            connection.send(NOT_FOUND_RESPONSE)
+            return
+        device.handle_request(request, connection)
+
 
 # Base class for a generic UPnP device. This is far from complete
 # but it supports either specified or automatic IP address and port
@@ -110,145 +497,189 @@ class upnp_device(object):
         return upnp_device.this_host_ip
 
 
-    def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, other_headers = None, ip_address = None):
+    def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, other_headers = None, ip_address = None, http_server = None):
         self.listener = listener
         self.poller = poller
-        self.port = port
         self.root_url = root_url
         self.server_version = server_version
         self.persistent_uuid = persistent_uuid
         self.uuid = uuid.uuid4()
         self.other_headers = other_headers
+        self.closed = False
 
-        if ip_address:
-            self.ip_address = ip_address
+        self.owns_http_server = not http_server
+        if http_server:
+            # Share one listening socket with other devices, requests are routed by path
+            self.http_server = http_server
+            self.http_server.add_device(self)
         else:
-            self.ip_address = upnp_device.local_ip_address()
-
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.ip_address, self.port))
-        self.socket.listen(5)
-        if self.port == 0:
-            self.port = self.socket.getsockname()[1]
-        self.poller.add(self)
-        self.client_sockets = {}
+            self.http_server = upnp_http_server(poller, ip_address, port)
+            self.http_server.add_device(self, default = True)
+        self.ip_address = self.http_server.ip_address
+        self.port = self.http_server.port
+        self.search_responses = {}  # Search target to pre-rendered response
         self.listener.add_device(self)
 
-    def fileno(self):
-        return self.socket.fileno()
+    def close(self):
+        """Stop answering searches and requests, and release the port unless it is shared"""
+        self.closed = True
+        self.listener.remove_device(self)
+        self.http_server.remove_device(self)
+        if self.owns_http_server:
+            self.http_server.close()
 
-    def do_read(self, fileno):
-        if fileno == self.socket.fileno():
-            (client_socket, client_address) = self.socket.accept()
-            self.poller.add(self, client_socket.fileno())
-            self.client_sockets[client_socket.fileno()] = (client_socket, client_address)
-        else:
-            data, sender = self.client_sockets[fileno][0].recvfrom(4096)
-            if not data:
-                self.poller.remove(self, fileno)
-                del(self.client_sockets[fileno])
-            else:
-                self.handle_request(data, sender, self.client_sockets[fileno][0], self.client_sockets[fileno][1])
+    def get_paths(self):
+        return []
 
-    def handle_request(self, data, sender, socket, client_address):
+    def handle_request(self, request, connection):
         pass
 
     def get_name(self):
         return "unknown"
 
     def respond_to_search(self, destination, search_target):
+        if self.closed:
+            return  # Closed after the search response was scheduled
         dbg("Responding to search for %s" % self.get_name())
-        date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
+        if search_target not in self.search_responses:
+            self.search_responses[search_target] = self.render_search_response(search_target)
+        self.listener.send_response(with_date(self.search_responses[search_target]), destination)
+        SEARCH_RESPONSES.inc()
+
+    def render_search_response(self, search_target):
+        """Render the search response once, split around the DATE value"""
         location_url = self.root_url % {'ip_address' : self.ip_address, 'port' : self.port}
-        message = ("HTTP/1.1 200 OK\r\n"
-                  "CACHE-CONTROL: max-age=86400\r\n"
-                  "DATE: %s\r\n"
-                  "EXT:\r\n"
-                  "LOCATION: %s\r\n"
-                  "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
-                  "01-NLS: %s\r\n"
-                  "SERVER: %s\r\n"
-                  "ST: %s\r\n"
-                  "USN: uuid:%s::%s\r\n" % (date_str, location_url, self.uuid, self.server_version, search_target, self.persistent_uuid, search_target))
+        head = ("HTTP/1.1 200 OK\r\n"
+                "CACHE-CONTROL: max-age=86400\r\n"
+                "DATE: ")
+        tail = ("\r\n"
+                "EXT:\r\n"
+                "LOCATION: %s\r\n"
+                "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
+                "01-NLS: %s\r\n"
+                "SERVER: %s\r\n"
+                "ST: %s\r\n"
+                "USN: uuid:%s::%s\r\n" % (location_url, self.uuid, self.server_version, search_target, self.persistent_uuid, search_target))
         if self.other_headers:
             for header in self.other_headers:
-                message += "%s\r\n" % header
-        message += "\r\n"
-        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_socket.sendto(message, destination)
+                tail += "%s\r\n" % header
+        tail += "\r\n"
+        return (head, tail)
 
 
 # This subclass does the bulk of the work to mimic a WeMo switch on the network.
 
 class fauxmo(upnp_device):
+    serials = {}  # Serial to the name of the device using it, in this process
+
     @staticmethod
     def make_uuid(name):
         return ''.join(["%x" % sum([ord(c) for c in name])] + ["%x" % ord(c) for c in "%sfauxmo!" % name])[:14]
 
-    def __init__(self, name, listener, poller, ip_address, port, action_handler = None):
-        self.serial = self.make_uuid(name)
+    @classmethod
+    def unique_serial(cls, name):
+        # make_uuid only keeps the first few characters of a name and the sum of
+        # all of them, so e.g. "bedroom 12" and "bedroom 21" get the same serial.
+        # The first device keeps it, so devices already discovered keep theirs,
+        # the others get one hashed from the whole name.
+        serial = cls.make_uuid(name)
+        attempt = 0
+        while cls.serials.get(serial, name) != name:
+            serial = hashlib.sha1("%s#%d" % (name, attempt)).hexdigest()[:14]
+            attempt += 1
+        return serial
+
+    def __init__(self, name, listener, poller, ip_address, port, action_handler = None, http_server = None, executor = None):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')  # Names from JSON, setup.xml and its length are in bytes
+        self.serial = self.unique_serial(name)
+        # The same name twice shares the serial, and the second device is refused for its paths
+        self.owns_serial = self.serial not in fauxmo.serials
+        fauxmo.serials[self.serial] = name
+        # With an executor, SetBinaryState is acknowledged right away and the action runs on a worker
+        self.executor = executor
         self.name = name
         self.ip_address = ip_address
+        # Devices on a shared server are told apart by a path prefix in their URLs
+        self.path_prefix = "/" + self.serial if http_server else ""
         persistent_uuid = "Socket-1_0-" + self.serial
         other_headers = ['X-User-Agent: redsonic']
-        upnp_device.__init__(self, listener, poller, port, "http://%(ip_address)s:%(port)s/setup.xml", "Unspecified, UPnP/1.0, Unspecified", persistent_uuid, other_headers=other_headers, ip_address=ip_address)
+        root_url = "http://%(ip_address)s:%(port)s" + self.path_prefix + "/setup.xml"
+        try:
+            upnp_device.__init__(self, listener, poller, port, root_url, "Unspecified, UPnP/1.0, Unspecified", persistent_uuid, other_headers=other_headers, ip_address=ip_address, http_server=http_server)
+        except:
+            self.release_serial()
+            raise
         if action_handler:
             self.action_handler = action_handler
         else:
             self.action_handler = self
+        xml = SETUP_XML % {'device_name' : self.name, 'device_serial' : self.serial, 'control_url' : self.path_prefix + CONTROL_PATH}
+        self.setup_response = ("HTTP/1.1 200 OK\r\n"
+                               "CONTENT-LENGTH: %d\r\n"
+                               "CONTENT-TYPE: text/xml\r\n"
+                               "DATE: " % len(xml),
+                               "\r\n"
+                               "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
+                               "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                               "X-User-Agent: redsonic\r\n"
+                               "CONNECTION: close\r\n"
+                               "\r\n" + xml)
         dbg("FauxMo device '%s' ready on %s:%s" % (self.name, self.ip_address, self.port))
 
+    def close(self):
+        upnp_device.close(self)
+        self.release_serial()
+
+    def release_serial(self):
+        if self.owns_serial:
+            self.owns_serial = False
+            del(fauxmo.serials[self.serial])
+
     def get_name(self):
         return self.name
 
-    def handle_request(self, data, sender, socket, client_address):
-        if data.find('GET /setup.xml HTTP/1.1') == 0:
+    def get_paths(self):
+        return [self.path_prefix + "/setup.xml", self.path_prefix + CONTROL_PATH]
+
+    def get_dispatch_key(self):
+        """Actions with the same key run one at a time, by default one key per handler"""
+        if hasattr(self.action_handler, 'dispatch_key'):
+            return self.action_handler.dispatch_key(self.name)
+        return id(self.action_handler)
+
+    def handle_request(self, request, connection):
+        client_address = connection.client_address
+        if request.method == 'GET' and request.path == self.path_prefix + '/setup.xml':
             dbg("Responding to setup.xml for %s" % self.name)
-            xml = SETUP_XML % {'device_name' : self.name, 'device_serial' : self.serial}
-            date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-            message = ("HTTP/1.1 200 OK\r\n"
-                       "CONTENT-LENGTH: %d\r\n"
-                       "CONTENT-TYPE: text/xml\r\n"
-                       "DATE: %s\r\n"
-                       "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
-                       "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                       "X-User-Agent: redsonic\r\n"
-                       "CONNECTION: close\r\n"
-                       "\r\n"
-                       "%s" % (len(xml), date_str, xml))
-            socket.send(message)
-        elif data.find('SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"') != -1:
-            success = False
-            if data.find('<BinaryState>1</BinaryState>') != -1:
-                # on
-                dbg("Responding to ON for %s" % self.name)
-                success = self.action_handler.on(client_address[0], self.name)
-            elif data.find('<BinaryState>0</BinaryState>') != -1:
-                # off
-                dbg("Responding to OFF for %s" % self.name)
-                success = self.action_handler.off(client_address[0], self.name)
+            SETUP_FETCHES.inc(trigger=self.name)
+            connection.send(with_date(self.setup_response))
+        elif request.headers.get('soapaction', '').strip('"') == 'urn:Belkin:service:basicevent:1#SetBinaryState':
+            if request.body.find('<BinaryState>1</BinaryState>') != -1:
+                state, action = "ON", self.action_handler.on
+            elif request.body.find('<BinaryState>0</BinaryState>') != -1:
+                state, action = "OFF", self.action_handler.off
             else:
                 dbg("Unknown Binary State request:")
-                dbg(data)
-            if success:
+                dbg(request.body)
+                connection.close()
+                return
+            SET_BINARY_STATE.inc(trigger=self.name, state=state)
+            if self.executor:
+                # Acknowledge first, the action runs on a worker thread
+                dbg("Queueing %s for %s" % (state, self.name))
+                connection.send(with_date(SOAP_RESPONSE))
+                self.executor.submit(self.get_dispatch_key(), action, client_address[0], self.name)
+            elif action(client_address[0], self.name):
+                dbg("Responded to %s for %s" % (state, self.name))
                 # The echo is happy with the 200 status code and doesn't
                 # appear to care about the SOAP response body
-                soap = ""
-                date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-                message = ("HTTP/1.1 200 OK\r\n"
-                           "CONTENT-LENGTH: %d\r\n"
-                           "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
-                           "DATE: %s\r\n"
-                           "EXT:\r\n"
-                           "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                           "X-User-Agent: redsonic\r\n"
-                           "CONNECTION: close\r\n"
-                           "\r\n"
-                           "%s" % (len(soap), date_str, soap))
-                socket.send(message)
+                connection.send(with_date(SOAP_RESPONSE))
+            else:
+                connection.close()
         else:
-            dbg(data)
+            dbg("%s %s" % (request.method, request.path))
+            connection.close()
 
     def on(self):
         return False
@@ -267,10 +698,14 @@ class fauxmo(upnp_device):
 # doesn't search for root devices.
 
 class upnp_broadcast_responder(object):
-    TIMEOUT = 0
+    # Longest window we spread search responses over, whatever MX the searcher asks for
+    MAX_MX = 5
+    MX_PATTERN = re.compile(r'^MX:\s*(\d+)', re.IGNORECASE | re.MULTILINE)
 
-    def __init__(self):
+    def __init__(self, poller = None):
+        self.poller = poller
         self.devices = []
+        self.pending_searches = {}
 
     def init_socket(self):
         ok = True
@@ -283,6 +718,10 @@ class upnp_broadcast_responder(object):
             #Set up server socket
             self.ssock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
             self.ssock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            self.ssock.setblocking(0)
+
+            #One socket shared by every device's search responses
+            self.rsock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
 
             try:
                 self.ssock.bind(('',self.port))
@@ -306,37 +745,64 @@ class upnp_broadcast_responder(object):
         return self.ssock.fileno()
 
     def do_read(self, fileno):
-        data, sender = self.recvfrom(1024)
-        if data:
+        # Drain every datagram that is already queued, the socket is non-blocking
+        while True:
+            data, sender = self.recvfrom(1024)
+            if not data:
+                break
             if data.find('M-SEARCH') == 0 and data.find('urn:Belkin:device:**') != -1:
-                for device in self.devices:
-                    time.sleep(0.5)
-                    device.respond_to_search(sender, 'urn:Belkin:device:**')
+                SEARCHES_RECEIVED.inc()
+                mx = self.MX_PATTERN.search(data)
+                self.schedule_responses(sender, 'urn:Belkin:device:**', int(mx.group(1)) if mx else 1)
             else:
                 pass
 
+    def schedule_responses(self, destination, search_target, mx):
+        """Spread one response per device evenly across the searcher's MX window.
+
+        The responses go out from poller timers, so the loop keeps serving
+        requests during a sweep. A repeated search from a searcher whose
+        sweep is still running is ignored.
+        """
+        if destination in self.pending_searches:
+            dbg("Search from %s already being answered" % (destination,))
+            return
+        devices = list(self.devices)
+        if not self.poller:
+            for device in devices:
+                device.respond_to_search(destination, search_target)
+            return
+
+        window = float(max(1, min(mx, self.MAX_MX)))
+        step = window / max(len(devices), 1)
+        self.pending_searches[destination] = [self.poller.call_later(i * step, device.respond_to_search, destination, search_target)
+                                              for i, device in enumerate(devices)]
+        self.poller.call_later(window, self.pending_searches.pop, destination, None)
+
     #Receive network data
     def recvfrom(self,size):
-        if self.TIMEOUT:
-            self.ssock.setblocking(0)
-            ready = select.select([self.ssock], [], [], self.TIMEOUT)[0]
-        else:
-            self.ssock.setblocking(1)
-            ready = True
-
         try:
-            if ready:
-                return self.ssock.recvfrom(size)
-            else:
-                return False, False
+            return self.ssock.recvfrom(size)
         except Exception, e:
-            dbg(e)
+            if not isinstance(e, socket.error) or e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                dbg(e)
             return False, False
 
+    def send_response(self, message, destination):
+        try:
+            self.rsock.sendto(message, destination)
+        except socket.error, e:
+            dbg("Failed to send search response to %s: %s" % (destination, e))
+
     def add_device(self, device):
         self.devices.append(device)
         dbg("UPnP broadcast listener: new device registered")
 
+    def remove_device(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+            dbg("UPnP broadcast listener: device removed")
+
 
 # This is an example handler class. The fauxmo class expects handlers to be
 # instances of objects that have on() and off() methods that return True
@@ -384,7 +850,7 @@ if __name__ == "__main__":
     p = poller()
 
     # Set up our singleton listener for UPnP broadcasts
-    u = upnp_broadcast_responder()
+    u = upnp_broadcast_responder(p)
     u.init_socket()
 
     # Add the UPnP broadcast listener to the poller so we can respond
@@ -397,12 +863,8 @@ if __name__ == "__main__":
 
     dbg("Entering main loop\n")
 
-    while True:
-        try:
-            # Allow time for a ctrl-c to stop the process
-            p.poll(100)
-            time.sleep(0.1)
-        except Exception, e:
-            dbg(e)
-            break
+    try:
+        p.run_forever()
+    except Exception, e:
+        dbg(e)
 
@@ -3,14 +3,35 @@ from ws4py.client.threadedclient import WebSocketClient
 from types import FunctionType
 from wakeonlan import wol
 from inspect import getargspec
+import array
+import errno
+import fcntl
 import json
+import logging
 import socket
+import threading
 import subprocess
 import re
 import os
+import random
+import select
+import shlex
+import SocketServer
+import struct
 import sys
+import time
+import unicodedata
 import urllib
 
+import metrics
+
+
+SETTINGS_FILE = "~/.lgtv.json"
+REGISTRY_DIR = "~/.lgtv"  # Settings of each TV when there is more than one
+DISCOVERY_CACHE_FILE = "~/.lgtv-discovery.json"
+DAEMON_SOCKET = "~/.lgtv.sock"  # Where "lgtv.py daemon" takes commands
+WEBOS_PORT = 3000
+ROUND_TRIP_SECONDS = metrics.histogram('lgtv_round_trip_seconds', 'Time from sending a command to its first response', ['uri'])
 
 hello_data = {
     "id": "register_0",
@@ -88,62 +109,174 @@ hello_data = {
 }
 
 
-def LGTVScan(first_only=False):
-    request = 'M-SEARCH * HTTP/1.1\r\n' \
-              'HOST: 239.255.255.250:1900\r\n' \
-              'MAN: "ssdp:discover"\r\n' \
-              'MX: 2\r\n' \
-              'ST: urn:schemas-upnp-org:device:MediaRenderer:1\r\n\r\n'
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+SSDP_MX = 2  # Seconds TVs may wait before answering a search
+SEARCH_REQUEST = 'M-SEARCH * HTTP/1.1\r\n' \
+                 'HOST: 239.255.255.250:1900\r\n' \
+                 'MAN: "ssdp:discover"\r\n' \
+                 'MX: %d\r\n' \
+                 'ST: urn:schemas-upnp-org:device:MediaRenderer:1\r\n\r\n'
+HEADER_PATTERN = re.compile(r'^([^:\r\n]+):[ \t]*(.*?)[ \t]*\r?$', re.MULTILINE)
+USN_UUID_PATTERN = re.compile(r'uuid:([^:\s]+)')
+MODEL_PATTERN = re.compile(r'\[LG\] webOS TV (.*)')
+MAX_AGE_PATTERN = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+DEFAULT_MAX_AGE = 1800  # Seconds a TV is remembered when it doesn't say
+
+
+SIOCGIFCONF = 0x8912
+
 
+def interfaceAddresses():
+    """IPv4 addresses of every configured interface, asked of the kernel with SIOCGIFCONF"""
+    # struct ifreq is a 16 byte name and a 16 byte union, padded to 40 bytes on 64 bit hosts
+    size = 40 if struct.calcsize('P') == 8 else 32
+    buf = array.array('B', '\0' * size * 64)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(1)
-
-    addresses = []
-    attempts = 4
-    while attempts > 0:
-        sock.sendto(request, ('239.255.255.250', 1900))
-        uuid = None
-        model = None
-        address = None
-        data = {}
+    try:
+        ifconf = struct.pack('iP', len(buf), buf.buffer_info()[0])
+        length = struct.unpack('iP', fcntl.ioctl(sock.fileno(), SIOCGIFCONF, ifconf))[0]
+    finally:
+        sock.close()
+    data = buf.tostring()
+    # Each sockaddr_in starts after the name with family and port, then the address
+    return [socket.inet_ntoa(data[offset + 20:offset + 24]) for offset in range(0, length, size)]
+
+
+def localAddresses():
+    """IPv4 addresses of this host's interfaces, without loopback"""
+    addresses = set()
+    try:
+        addresses.update(interfaceAddresses())
+    except (IOError, OSError):
+        pass
+    # Fallbacks should the ioctl fail
+    try:
+        addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    except socket.error:
+        pass
+    # The address of the interface with the default route, which gethostname() often misses
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(('8.8.8.8', 53))
+        addresses.add(probe.getsockname()[0])
+    except socket.error:
+        pass
+    finally:
+        probe.close()
+    return sorted(address for address in addresses if not address.startswith('127.'))
+
+
+def parseSearchResponse(response, address):
+    """Return the TV described by an M-SEARCH response, None if it isn't an LG TV"""
+    if 'LG' not in response:
+        return None
+    headers = dict((name.strip().lower(), value) for name, value in HEADER_PATTERN.findall(response))
+    uuid = USN_UUID_PATTERN.search(headers.get('usn', ''))
+    # LG sends DLNADeviceName.lge.com
+    device_name = ''.join(value for name, value in headers.items() if name.startswith('dlnadevicename'))
+    model = MODEL_PATTERN.search(urllib.unquote(device_name))
+    max_age = MAX_AGE_PATTERN.search(headers.get('cache-control', ''))
+    return {
+        'uuid': uuid.group(1) if uuid else None,
+        'model': model.group(1) if model else None,
+        'address': address[0],
+        'max_age': int(max_age.group(1)) if max_age else DEFAULT_MAX_AGE
+    }
+
+
+def LGTVDiscover(mx=SSDP_MX, addresses=None):
+    """Search for TVs on every local interface, yielding each TV as its first response arrives.
+
+    Responses are collected until the MX window (plus a second of slack) is
+    over, and each TV is yielded once, told apart by the uuid of its USN.
+    """
+    sockets = []
+    for address in addresses or localAddresses() or ['0.0.0.0']:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            response, address = sock.recvfrom(512)
-            # print response
-            for line in response.split('\n'):
-                if line.startswith("USN"):
-                    uuid = re.findall(r'uuid:(.*?):', line)[0]
-                if line.startswith("DLNADeviceName"):
-                    (junk, data) = line.split(':')
-                    data = data.strip()
-                    data = urllib.unquote(data)
-                    model = re.findall(r'\[LG\] webOS TV (.*)', data)[0]
-                data = {
-                    'uuid': uuid,
-                    'model': model,
-                    'address': address[0]
-                }
-        except Exception as e:
-            print e.message
-            attempts -= 1
+            sock.bind((address, 0))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.setblocking(0)
+        except socket.error as e:
+            logging.debug('Not searching from {}: {}'.format(address, e))
+            sock.close()
             continue
+        sockets.append(sock)
+
+    request = SEARCH_REQUEST % mx
+    deadline = time.time() + mx + 1
+    resend_at = time.time() + mx / 2.0  # Search again in case the first datagram was lost
+    searches_left = 2
+    seen = set()
+    try:
+        while True:
+            now = time.time()
+            if searches_left and (searches_left == 2 or now >= resend_at):
+                for sock in sockets:
+                    try:
+                        sock.sendto(request, SSDP_ADDRESS)
+                    except socket.error as e:
+                        logging.debug('Search from {} failed: {}'.format(sock.getsockname()[0], e))
+                searches_left -= 1
+            if now >= deadline or not sockets:
+                break
+            wakeup = deadline if not searches_left else min(deadline, resend_at)
+            readable = select.select(sockets, [], [], max(0, wakeup - now))[0]
+            for sock in readable:
+                while True:
+                    try:
+                        response, address = sock.recvfrom(65507)
+                    except socket.error as e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            logging.debug('Receive failed: {}'.format(e))
+                        break
+                    tv = parseSearchResponse(response, address)
+                    if tv is None:
+                        continue
+                    key = tv['uuid'] or tv['address']
+                    if key not in seen:
+                        seen.add(key)
+                        yield tv
+    finally:
+        for sock in sockets:
+            sock.close()
 
-        if re.search('LG', response):
-            if first_only:
-                sock.close()
-                return data
-            else:
-                addresses.append(data)
-
-        attempts -= 1
 
-    sock.close()
+def LGTVScan(first_only=False):
     if first_only:
+        for tv in LGTVDiscover():
+            return tv
         return []
+    return list(LGTVDiscover())
 
-    if len(addresses) == 0:
-        return []
 
-    return list(set(addresses))
+WOL_BURST = 3  # Magic packets per wake up, a lone UDP datagram is easily lost
+WOL_BURST_INTERVAL = 0.05  # Seconds between the packets of a burst
+ARP_TABLE = "/proc/net/arp"
+ATF_COM = 0x2  # Neighbour table flag of a resolved entry
+MAC_TTL = 300  # Seconds a MAC address is remembered
+MAC_PROBE_TIMEOUT = 1  # Seconds to wait for the kernel to resolve a probed address
+mac_memo = {}  # Address to (MAC address, when it expires)
+mac_memo_lock = threading.Lock()
+
+
+def sendMagicPackets(mac):
+    """Send a burst of Wake-on-LAN packets to mac"""
+    for i in range(WOL_BURST):
+        if i:
+            time.sleep(WOL_BURST_INTERVAL)
+        wol.send_magic_packet(mac)
+
+
+def isPortOpen(host, port, timeout):
+    """Return True if a TCP connection to host:port succeeds within timeout seconds"""
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
 
 
 def resolveHost(hostname):
@@ -151,15 +284,214 @@ def resolveHost(hostname):
 
 
 def getMacAddress(address):
-    pid = subprocess.Popen(["arp", "-n", address], stdout=subprocess.PIPE)
+    """Return the MAC address of address on the local network, None if it can't be found.
+
+    Answers come from a memo for MAC_TTL seconds, then from the kernel's
+    neighbour table. An address that isn't in the table is sent a probe
+    datagram so the kernel resolves it.
+    """
+    now = time.time()
+    with mac_memo_lock:
+        memo = mac_memo.get(address)
+        if memo is not None and memo[1] > now:
+            return memo[0]
+
+    if os.path.exists(ARP_TABLE):
+        mac = readArpTable(address)
+        if mac is None:
+            mac = probeMacAddress(address)
+    else:
+        mac = arpCommandMacAddress(address)  # No /proc, e.g. macOS
+
+    if mac is not None:
+        with mac_memo_lock:
+            mac_memo[address] = (mac, now + MAC_TTL)
+    return mac
+
+
+def readArpTable(address):
+    """Look address up in /proc/net/arp, returns its MAC address or None"""
+    try:
+        with open(ARP_TABLE) as f:
+            lines = f.readlines()[1:]  # Skip the column titles
+    except IOError:
+        return None
+    for line in lines:
+        # IP address, HW type, Flags, HW address, Mask, Device
+        fields = line.split()
+        if len(fields) >= 4 and fields[0] == address and int(fields[2], 16) & ATF_COM:
+            return normalizeMacAddress(fields[3])
+    return None
+
+
+def probeMacAddress(address):
+    """Make the kernel resolve address with a datagram to its discard port, then read the table again"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.sendto('', (address, 9))
+    except socket.error as e:
+        logging.debug('MAC probe of {} failed: {}'.format(address, e))
+        return None
+    finally:
+        probe.close()
+    deadline = time.time() + MAC_PROBE_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        mac = readArpTable(address)
+        if mac is not None:
+            return mac
+    return None
+
+
+def arpCommandMacAddress(address):
+    try:
+        pid = subprocess.Popen(["arp", "-n", address], stdout=subprocess.PIPE)
+    except OSError:
+        return None
     s = pid.communicate()[0]
     matches = re.search(r"(([a-f\d]{1,2}\:){5}[a-f\d]{1,2})", s)
     if not matches:
         return None
-    mac = matches.groups()[0]
-    m = mac.split(':')
-    mac = ':'.join(['%02x' % int(x, 16) for x in m])
-    return mac
+    return normalizeMacAddress(matches.groups()[0])
+
+
+def normalizeMacAddress(mac):
+    return ':'.join(['%02x' % int(x, 16) for x in mac.split(':')])
+
+
+class LGTVDiscoveryCache(object):
+    """TVs found by LGTVDiscover by uuid (address, model, mac), kept in memory and on disk.
+
+    Each TV is trusted until the CACHE-CONTROL max-age of its last search
+    response runs out. Lookups are answered from memory and only search the
+    network again when the TV asked for has expired or was invalidated, e.g.
+    after a failed connection. start_refresh() keeps the entries fresh from a
+    background thread instead.
+    """
+    REFRESH_MARGIN = 0.1  # Part of max-age left when the background thread searches again
+    MIN_REFRESH_SECONDS = 60  # Least time between background searches, TVs that are off stay expired
+    MAX_REFRESH_SECONDS = 3600  # Most time between searches for TVs that keep not answering
+
+    def __init__(self, path=DISCOVERY_CACHE_FILE, mx=SSDP_MX):
+        self.path = os.path.expanduser(path)
+        self.mx = mx
+        self.__entries = {}  # uuid to {'uuid', 'address', 'model', 'mac', 'expires'}
+        self.__lock = threading.Lock()
+        self.__refresh_lock = threading.Lock()  # One search at a time
+        self.__refresh_thread = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.__entries = json.loads(f.read())
+            except ValueError:
+                logging.warning('Ignoring corrupt discovery cache {}'.format(self.path))
+
+    def tvs(self, fresh_only=True):
+        now = time.time()
+        with self.__lock:
+            return [dict(entry) for entry in self.__entries.values() if not fresh_only or entry['expires'] > now]
+
+    def lookup(self, uuid):
+        """Return the entry of the TV with uuid, searching again first if it has expired.
+
+        A TV that doesn't answer the search keeps its last known (expired)
+        entry, its mac is still good for Wake-on-LAN. None if it was never seen.
+        """
+        with self.__lock:
+            entry = self.__entries.get(uuid)
+            if entry is not None and entry['expires'] > time.time():
+                return dict(entry)
+        self.refresh()
+        with self.__lock:
+            entry = self.__entries.get(uuid)
+            return dict(entry) if entry is not None else None
+
+    def find_address(self, address):
+        """Return the entry of the TV last seen at address, without going to the network"""
+        with self.__lock:
+            for entry in self.__entries.values():
+                if entry['address'] == address:
+                    return dict(entry)
+        return None
+
+    def invalidate(self, uuid):
+        """Expire uuid's entry, the next lookup searches the network again"""
+        with self.__lock:
+            if uuid in self.__entries:
+                self.__entries[uuid]['expires'] = 0
+
+    def refresh(self):
+        """Search the network and update the entries of the TVs that answer, returns them"""
+        with self.__refresh_lock:
+            found = []
+            for tv in LGTVDiscover(self.mx):
+                if tv['uuid'] is None:
+                    continue
+                with self.__lock:
+                    previous = self.__entries.get(tv['uuid'], {})
+                # arp only knows the address right after the TV answered, and only needs asking when it moved
+                mac = previous.get('mac') if previous.get('address') == tv['address'] else None
+                entry = {
+                    'uuid': tv['uuid'],
+                    'address': tv['address'],
+                    'model': tv['model'],
+                    'mac': mac or getMacAddress(tv['address']),
+                    'expires': time.time() + tv['max_age'],
+                    'max_age': tv['max_age']
+                }
+                with self.__lock:
+                    self.__entries[tv['uuid']] = entry
+                found.append(dict(entry))
+            self.save()
+            return found
+
+    def save(self):
+        with self.__lock:
+            data = json.dumps(self.__entries)
+        # Write a new file and rename it over the old one, so readers never see half a cache
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Couldn\'t save discovery cache {}: {}'.format(self.path, e))
+
+    def start_refresh(self):
+        """Search again from a daemon thread shortly before each entry expires"""
+        if self.__refresh_thread is None:
+            self.__refresh_thread = threading.Thread(target=self.__refresh_forever, name='lgtv-discovery')
+            self.__refresh_thread.daemon = True
+            self.__refresh_thread.start()
+
+    def __stale(self):
+        """True if no TV was found yet, or one has expired"""
+        now = time.time()
+        with self.__lock:
+            return not self.__entries or any(entry['expires'] <= now for entry in self.__entries.values())
+
+    def __next_refresh(self, stale_refresh):
+        """When to search next: before a fresh entry expires, or at stale_refresh for the expired ones"""
+        now = time.time()
+        with self.__lock:
+            fresh = [entry for entry in self.__entries.values() if entry['expires'] > now]
+        times = [entry['expires'] - entry.get('max_age', DEFAULT_MAX_AGE) * self.REFRESH_MARGIN for entry in fresh]
+        if self.__stale():
+            times.append(stale_refresh)
+        return min(times)
+
+    def __refresh_forever(self):
+        last_refresh = 0
+        backoff = self.MIN_REFRESH_SECONDS  # Between searches for expired TVs, doubled while they stay expired
+        while True:
+            time.sleep(max(0, self.__next_refresh(last_refresh + backoff) - time.time(), last_refresh + self.MIN_REFRESH_SECONDS - time.time()))
+            last_refresh = time.time()
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception('Discovery refresh failed')
+            # A TV that is off or gone doesn't answer the next search either
+            backoff = min(backoff * 2, self.MAX_REFRESH_SECONDS) if self.__stale() else self.MIN_REFRESH_SECONDS
 
 
 def methods(cls):
@@ -171,7 +503,10 @@ def getCommands(cls):
         'opened',
         'closed',
         'received_message',
-        'exec_command'
+        'exec_command',
+        'wait_for_handshake',
+        'ponged',
+        '_write'
     ]
     out = []
     m = methods(cls)
@@ -187,39 +522,108 @@ def getCommands(cls):
     return out
 
 
+class LGTVRequest(object):
+    """A command sent to the TV, resolved when the response carrying its id arrives"""
+    def __init__(self, request_id, uri, callback=None, subscription=False, forget=None):
+        self.id = request_id
+        self.uri = uri
+        self.callback = callback
+        self.subscription = subscription
+        self.__forget = forget  # Called with the request when no reply is expected any more
+        self.response = None
+        self.sent_at = time.time()
+        self.__event = threading.Event()
+        self.__done_callbacks = []
+        self.__lock = threading.Lock()
+
+    def done(self):
+        return self.__event.is_set()
+
+    def add_done_callback(self, fn):
+        """Call fn(response) once the first response arrives, right away if it already has.
+
+        Lets an event loop chain on the request instead of blocking in wait(), e.g.
+        request.add_done_callback(lambda r: loop.call_soon_threadsafe(handle, r))
+        """
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__done_callbacks.append(fn)
+                return
+        fn(self.response)
+
+    def wait(self, timeout=None):
+        """Block until the first response arrives, returns it or None on timeout.
+
+        A request (not a subscription) that times out is cancelled, a late reply to it is ignored.
+        """
+        if not self.__event.wait(timeout) and not self.subscription:
+            self.cancel()
+        return self.response
+
+    def cancel(self):
+        """Stop waiting for the reply, so the connection doesn't keep the request around"""
+        if self.__forget is not None:
+            self.__forget(self)
+
+    def resolve(self, response):
+        with self.__lock:
+            first = not self.__event.is_set()
+            self.response = response
+            self.__event.set()
+            done_callbacks, self.__done_callbacks = self.__done_callbacks, []
+        if self.callback:
+            self.callback(response)
+        if first:
+            for fn in done_callbacks:
+                fn(response)
+
+
 class LGTVClient(WebSocketClient):
-    def __init__(self, hostname=None):
+    REQUEST_TIMEOUT = 60  # Seconds before a request nobody waits on is given up on, for a TV that drops replies
+
+    def __init__(self, hostname=None, persistent=False, port=WEBOS_PORT, settings_file=SETTINGS_FILE, discovery=None):
         self.__command_count = 0
         self.__waiting_callback = None
-        if os.path.exists(os.path.expanduser("~/.lgtv.json")):
-            f = open(os.path.expanduser("~/.lgtv.json"))
+        self.__pending = {}  # Request id to LGTVRequest awaiting a response
+        self.__pending_lock = threading.Lock()
+        self.__last_expiry = time.time()
+        self.__send_lock = threading.Lock()  # Frames from different threads mustn't interleave
+        self.__persistent = persistent
+        self.__handshake_event = threading.Event()
+        self.last_heard = time.time()  # When the TV last sent anything, pongs included
+        self.__settings_file = os.path.expanduser(settings_file)
+        if os.path.exists(self.__settings_file):
+            f = open(self.__settings_file)
             settings = json.loads(f.read())
             f.close()
             self.__hostname = settings['hostname']
             self.__clientKey = settings["client-key"]
             self.__ip = settings['ip']
             self.__macAddress = settings['mac-address']
+            self.__uuid = settings.get('uuid')
             if not self.__macAddress and self.__ip is not None:
-                self.__macAddress = getMacAddress(self.__ip)
+                self.__identify(discovery)
                 self.__store_settings()
         else:
             self.__hostname = hostname
             if hostname is not None:
                 self.__clientKey = None
                 self.__ip = resolveHost(hostname)
-                self.__macAddress = getMacAddress(self.__ip)
+                self.__uuid = None
+                self.__identify(discovery)
                 self.__store_settings()
             else:
                 self.__ip = None
         self.__handshake_done = False
-        super(LGTVClient, self).__init__('ws://' + self.__hostname + ':3000/', exclude_headers=["Origin"])
+        super(LGTVClient, self).__init__('ws://' + self.__hostname + ':' + str(port) + '/', exclude_headers=["Origin"])
         self.__waiting_command = None
 
     def __exec_command(self):
         if self.__handshake_done is False:
             print "Error: Handshake failed"
         if self.__waiting_command is None or len(self.__waiting_command.keys()) == 0:
-            self.close()
+            if not self.__persistent:
+                self.close()
             return
         command = self.__waiting_command.keys()[0]
         args = self.__waiting_command[command]
@@ -230,14 +634,27 @@ class LGTVClient(WebSocketClient):
             usage("Invalid command")
         self.__waiting_command = {command: args}
 
+    def wait_for_handshake(self, timeout=None):
+        """Block until the register handshake has completed, returns True if paired"""
+        self.__handshake_event.wait(timeout)
+        return self.__handshake_done
+
+    def __identify(self, discovery):
+        """Find the MAC address (and uuid) of the TV at self.__ip, from the discovery cache if it has seen it"""
+        known = discovery.find_address(self.__ip) if discovery else None
+        if known is not None:
+            self.__uuid = known['uuid']
+        self.__macAddress = known['mac'] if known is not None and known['mac'] else getMacAddress(self.__ip)
+
     def __store_settings(self):
         data = {
             "client-key": self.__clientKey,
             "mac-address": self.__macAddress,
             "ip": self.__ip,
-            "hostname": self.__hostname
+            "hostname": self.__hostname,
+            "uuid": self.__uuid
         }
-        f = open(os.path.expanduser("~/.lgtv.json"), "w")
+        f = open(self.__settings_file, "w")
         f.write(json.dumps(data))
         f.close()
 
@@ -247,9 +664,19 @@ class LGTVClient(WebSocketClient):
             self.__waiting_callback = self.__handshake
         else:
             self.__waiting_callback = self.__prompt
-        ws.send(json.dumps(hello_data))
+        self.send(json.dumps(hello_data))
 
     def closed(self, code, reason=None):
+        self.__handshake_event.set()
+        if self.__persistent:
+            logging.info('LGTV connection closed: {} {}'.format(code, reason))
+            # Fail whatever was still in flight so nobody waits on a dead socket
+            with self.__pending_lock:
+                pending = self.__pending.values()
+                self.__pending = {}
+            for request in pending:
+                request.resolve({"type": "error", "id": request.id, "error": "connection closed", "payload": {}})
+            return
         print json.dumps({
             "closing": {
                 "code": code,
@@ -257,12 +684,34 @@ class LGTVClient(WebSocketClient):
             }
         })
 
+    def ponged(self, pong):
+        self.last_heard = time.time()
+
+    def _write(self, b):
+        # Every frame goes out here: commands, pings, the pongs ws4py answers with, close
+        with self.__send_lock:
+            super(LGTVClient, self)._write(b)
+
     def received_message(self, response):
-        if self.__waiting_callback:
-            self.__waiting_callback(json.loads(str(response)))
+        self.last_heard = time.time()
+        response = json.loads(str(response))
+        with self.__pending_lock:
+            request = self.__pending.get(response.get('id'))
+            if request is not None and not request.subscription:
+                del self.__pending[request.id]
+        if request is not None:
+            if not request.done():
+                ROUND_TRIP_SECONDS.observe(time.time() - request.sent_at, uri=request.uri)
+            request.resolve(response)
+        elif self.__waiting_callback:
+            self.__waiting_callback(response)
 
     def __defaultHandler(self, response):
         # {"type":"response","id":"0","payload":{"returnValue":true}}
+        if self.__persistent:
+            # Resident connections stay open for the next command
+            logging.debug(json.dumps(response))
+            return
         if response['type'] == "error":
             print json.dumps(response)
             self.close()
@@ -281,6 +730,8 @@ class LGTVClient(WebSocketClient):
     def __handshake(self, response):
         if 'client-key' in response['payload'].keys():
             self.__handshake_done = True
+            self.__waiting_callback = None
+            self.__handshake_event.set()
             self.__exec_command()
 
     def __set_client_key(self, response):
@@ -294,108 +745,128 @@ class LGTVClient(WebSocketClient):
     def on(self):
         if not self.__macAddress:
             print "Client must have been powered on and paired before power on works"
-        wol.send_magic_packet(self.__macAddress)
+        sendMagicPackets(self.__macAddress)
 
     def off(self):
-        self.__send_command("", "request", "ssap://system/turnOff")
+        return self.__send_command("", "request", "ssap://system/turnOff")
 
     def openBrowserAt(self, url, callback=None):
-        self.__send_command("", "request", "ssap://system.launcher/open", {"target": url}, callback)
+        return self.__send_command("", "request", "ssap://system.launcher/open", {"target": url}, callback)
 
     def notification(self, message, callback=None):
-        self.__send_command("", "request", "ssap://system.notifications/createToast", {"message": message}, callback)
+        return self.__send_command("", "request", "ssap://system.notifications/createToast", {"message": message}, callback)
 
     def mute(self, muted=True, callback=None):
-        self.__send_command("", "request", "ssap://audio/setMute", {"mute": muted}, callback)
+        return self.__send_command("", "request", "ssap://audio/setMute", {"mute": muted}, callback)
 
     def audioStatus(self, callback=None):
-        self.__send_command("status_", "request", "ssap://audio/getStatus", None, callback)
+        return self.__send_command("status_", "request", "ssap://audio/getStatus", None, callback)
 
     def audioVolume(self, callback=None):
-        self.__send_command("status_", "request", "ssap://audio/getVolume", None, callback)
+        return self.__send_command("status_", "request", "ssap://audio/getVolume", None, callback)
+
+    def subscribeVolume(self, callback=None):
+        return self.__send_command("volume_", "subscribe", "ssap://audio/getVolume", None, callback)
 
     def setVolume(self, level, callback=None):
-        self.__send_command("", "request", "ssap://audio/setVolume", {"volume": level}, callback)
+        return self.__send_command("", "request", "ssap://audio/setVolume", {"volume": level}, callback)
 
     def volumeUp(self, callback=None):
-        self.__send_command("volumeup_", "request", "ssap://audio/volumeUp", None, callback)
+        return self.__send_command("volumeup_", "request", "ssap://audio/volumeUp", None, callback)
 
     def volumeDown(self, callback=None):
-        self.__send_command("volumedown_", "request", "ssap://audio/volumeDown", None, callback)
+        return self.__send_command("volumedown_", "request", "ssap://audio/volumeDown", None, callback)
 
     def inputMediaPlay(self, callback=None):
-        self.__send_command("", "request", "ssap://media.controls/play", None, callback)
+        return self.__send_command("", "request", "ssap://media.controls/play", None, callback)
 
     def inputMediaStop(self, callback=None):
-        self.__send_command("", "request", "ssap://media.controls/stop", None, callback)
+        return self.__send_command("", "request", "ssap://media.controls/stop", None, callback)
 
     def inputMediaPause(self, callback=None):
-        self.__send_command("", "request", "ssap://media.controls/pause", None, callback)
+        return self.__send_command("", "request", "ssap://media.controls/pause", None, callback)
 
     def inputMediaRewind(self, callback=None):
-        self.__send_command("", "request", "ssap://media.controls/rewind", None, callback)
+        return self.__send_command("", "request", "ssap://media.controls/rewind", None, callback)
 
     def inputMediaFastForward(self, callback=None):
-        self.__send_command("", "request", "ssap://media.controls/fastForward", None, callback)
+        return self.__send_command("", "request", "ssap://media.controls/fastForward", None, callback)
 
     def inputChannelUp(self, callback=None):
-        self.__send_command("", "request", "ssap://tv/channelUp", None, callback)
+        return self.__send_command("", "request", "ssap://tv/channelUp", None, callback)
 
     def inputChannelDown(self, callback=None):
-        self.__send_command("", "request", "ssap://tv/channelDown", None, callback)
+        return self.__send_command("", "request", "ssap://tv/channelDown", None, callback)
 
     def setTVChannel(self, channel, callback=None):
-        self.__send_command("", "request", "ssap://tv/openChannel", {"channelId": channel}, callback)
+        return self.__send_command("", "request", "ssap://tv/openChannel", {"channelId": channel}, callback)
 
     def getTVChannel(self, callback=None):
-        self.__send_command("channels_", "request", "ssap://tv/getCurrentChannel", None, callback)
+        return self.__send_command("channels_", "request", "ssap://tv/getCurrentChannel", None, callback)
 
     def listChannels(self, callback=None):
-        self.__send_command("channels_", "request", "ssap://tv/getChannelList", None, callback)
+        return self.__send_command("channels_", "request", "ssap://tv/getChannelList", None, callback)
 
     def input3DOn(self, callback=None):
-        self.__send_command("", "request", "ssap://com.webos.service.tv.display/set3DOn", None, callback)
+        return self.__send_command("", "request", "ssap://com.webos.service.tv.display/set3DOn", None, callback)
 
     def input3DOff(self, callback=None):
-        self.__send_command("", "request", "ssap://com.webos.service.tv.display/set3DOff", None, callback)
+        return self.__send_command("", "request", "ssap://com.webos.service.tv.display/set3DOff", None, callback)
 
     def listInputs(self, callback=None):
-        self.__send_command("input_", "request", "ssap://tv/getExternalInputList", None, callback)
+        return self.__send_command("input_", "request", "ssap://tv/getExternalInputList", None, callback)
 
     def setInput(self, input_id, callback=None):
-        self.__send_command("", "request", "ssap://tv/switchInput", {"inputId": input_id}, callback)
+        return self.__send_command("", "request", "ssap://tv/switchInput", {"inputId": input_id}, callback)
 
     def swInfo(self, callback=None):
-        self.__send_command("sw_info_", "request", "ssap://com.webos.service.update/getCurrentSWInformation", None, callback)
+        return self.__send_command("sw_info_", "request", "ssap://com.webos.service.update/getCurrentSWInformation", None, callback)
 
     def listServices(self, callback=None):
-        self.__send_command("services_", "request", "ssap://api/getServiceList", None, callback)
+        return self.__send_command("services_", "request", "ssap://api/getServiceList", None, callback)
 
     def listApps(self, callback=None):
-        self.__send_command("launcher_", "request", "ssap://com.webos.applicationManager/listLaunchPoints", None, callback)
+        return self.__send_command("launcher_", "request", "ssap://com.webos.applicationManager/listLaunchPoints", None, callback)
+
+    def subscribeApps(self, callback=None):
+        return self.__send_command("launcher_", "subscribe", "ssap://com.webos.applicationManager/listLaunchPoints", None, callback)
 
     def openAppWithPayload(self, payload, callback=None):
-        self.__send_command("", "request", "ssap://com.webos.applicationManager/launch", payload, callback)
+        return self.__send_command("", "request", "ssap://com.webos.applicationManager/launch", payload, callback)
 
     def startApp(self, appid, callback=None):
-        self.__send_command("", "request", "ssap://system.launcher/launch", {'id': appid}, callback)
+        return self.__send_command("", "request", "ssap://system.launcher/launch", {'id': appid}, callback)
 
     def closeApp(self, appid, callback=None):
-        self.__send_command("", "request", "ssap://system.launcher/close", {'id': appid}, callback)
+        return self.__send_command("", "request", "ssap://system.launcher/close", {'id': appid}, callback)
 
     def openYoutubeId(self, videoid, callback=None):
-        self.openYoutubeURL("http://www.youtube.com/tv?v=" + videoid, callback)
+        return self.openYoutubeURL("http://www.youtube.com/tv?v=" + videoid, callback)
 
     def openYoutubeURL(self, url, callback=None):
         payload = {"id": "youtube.leanback.v4", "params": {"contentTarget": url}}
-        self.__send_command("", "request", "ssap://system.launcher/launch", payload, callback)
+        return self.__send_command("", "request", "ssap://system.launcher/launch", payload, callback)
+
+    def __forget(self, request):
+        with self.__pending_lock:
+            if self.__pending.get(request.id) is request:
+                del self.__pending[request.id]
 
     def __send_command(self, prefix, msgtype, uri, payload=None, callback=None):
         if not callback:
             callback = self.__defaultHandler
-        self.__waiting_callback = callback
+        with self.__pending_lock:
+            self.__command_count += 1
+            request = LGTVRequest(prefix + str(self.__command_count), uri, callback, msgtype == "subscribe", self.__forget)
+            self.__pending[request.id] = request
+            now = time.time()
+            if now - self.__last_expiry > self.REQUEST_TIMEOUT:
+                # Requests without a wait() that times out are only dropped here, now and then
+                self.__last_expiry = now
+                for stale in [other for other in self.__pending.values() if not other.subscription and now - other.sent_at > self.REQUEST_TIMEOUT]:
+                    del self.__pending[stale.id]
         message_data = {
-            'id': prefix + str(self.__command_count),
+            'id': request.id,
             'type': msgtype,
             'uri': uri
         }
@@ -405,6 +876,659 @@ class LGTVClient(WebSocketClient):
             message_data['payload'] = payload
 
         self.send(json.dumps(message_data))
+        return request
+
+
+class LGTVRegistry(object):
+    """Paired TVs by id, each with the settings (hostname, client-key, ip, mac-address) of its own file.
+
+    TV "name" keeps its settings in ~/.lgtv/name.json, in the same format as
+    ~/.lgtv.json, which is still used for the TV with the id "default".
+    """
+    DEFAULT_TV = "default"
+
+    def __init__(self, directory=REGISTRY_DIR, default_settings_file=SETTINGS_FILE):
+        self.directory = os.path.expanduser(directory)
+        self.default_settings_file = os.path.expanduser(default_settings_file)
+
+    def settings_file(self, tv_id):
+        if tv_id == self.DEFAULT_TV:
+            return self.default_settings_file
+        if not re.match(r'^[\w.-]+$', tv_id):
+            raise ValueError("Invalid TV id: {}".format(tv_id))
+        return os.path.join(self.directory, tv_id + ".json")
+
+    def prepare(self, tv_id):
+        """Return the settings file of tv_id, creating the registry directory for a new TV"""
+        settings_file = self.settings_file(tv_id)
+        if not os.path.isdir(os.path.dirname(settings_file)):
+            os.makedirs(os.path.dirname(settings_file))
+        return settings_file
+
+    def tv_ids(self):
+        ids = []
+        if os.path.exists(self.default_settings_file):
+            ids.append(self.DEFAULT_TV)
+        if os.path.isdir(self.directory):
+            ids.extend(sorted(f[:-len(".json")] for f in os.listdir(self.directory) if f.endswith(".json")))
+        return ids
+
+    def has(self, tv_id):
+        return os.path.exists(self.settings_file(tv_id))
+
+    def app_index_file(self, tv_id):
+        """Where the LGTVAppIndex of tv_id is kept"""
+        self.settings_file(tv_id)  # Checks the id
+        return os.path.join(self.directory, "apps", tv_id + ".json")
+
+    def load(self, tv_id):
+        with open(self.settings_file(tv_id)) as f:
+            return json.loads(f.read())
+
+    def update(self, tv_id, changes):
+        """Change some of the settings of tv_id, e.g. {"ip": ...}"""
+        settings = self.load(tv_id)
+        settings.update(changes)
+        with open(self.settings_file(tv_id), "w") as f:
+            f.write(json.dumps(settings))
+
+
+class LGTVPool(object):
+    """Persistent, paired connections to the TVs of a registry, keyed by TV id.
+
+    A connection is made on the first get() for its TV and reused until it
+    drops or has been idle for idle_timeout seconds. With a discovery cache,
+    a TV that can't be reached is looked for again by uuid in case it moved
+    to a new address.
+
+    power_on() wakes a TV and connects as soon as it has booted. Commands
+    handed to when_ready() in the meantime run, in order, right after.
+
+    keep_alive() connects to TVs right away instead, pings them to notice
+    dead sockets, and reconnects with jittered exponential backoff, so a
+    command never waits for a connect and handshake.
+    """
+    BOOT_PROBE_INTERVAL = 0.25  # Seconds before the first retry of a booting TV's port, doubled up to the max
+    BOOT_PROBE_MAX_INTERVAL = 1
+    WOL_RESEND_SECONDS = 5  # A booting TV that still isn't listening gets another burst this often
+    RECONNECT_MIN_SECONDS = 0.5  # Backoff before the first reconnect, doubled on each failure
+    RECONNECT_MAX_SECONDS = 60
+
+    def __init__(self, registry=None, idle_timeout=300, handshake_timeout=5, port=WEBOS_PORT, discovery=None, boot_timeout=60):
+        self.registry = registry or LGTVRegistry()
+        self.discovery = discovery
+        self.idle_timeout = idle_timeout
+        self.handshake_timeout = handshake_timeout
+        self.boot_timeout = boot_timeout
+        self.port = port
+        self.__clients = {}  # TV id to its LGTVClient
+        self.__last_used = {}  # TV id to when its connection was last handed out
+        self.__tv_locks = {}  # TV id to the lock held while connecting to it
+        self.__booting = {}  # TV id to the callbacks waiting for it to finish booting
+        self.__kept = set()  # TV ids keep_alive() keeps connected
+        self.__listeners = []
+        self.__lock = threading.Lock()
+        self.__reaper = None
+        self.__supervisor = None
+
+    def get(self, tv_id):
+        """Return the paired connection to tv_id, connecting first if there is no open one.
+
+        Returns:
+            LGTVClient, or None if the TV couldn't be reached or is still booting
+        """
+        with self.__lock:
+            if tv_id in self.__booting:
+                return None  # The boot thread connects once the TV is up
+        return self.__get(tv_id)
+
+    def __get(self, tv_id, search=True):
+        """The connection to tv_id, made again at the TV's new address if it can't be reached.
+
+        The TV is looked up without holding its lock, so commands don't queue
+        behind a network search. Without search only the discovery cache is asked.
+        """
+        try:
+            return self.__get_connected(tv_id)
+        except Exception as e:
+            logging.error('Couldn\'t connect to TV {}: {}'.format(tv_id, e))
+        if not self.__relocate(tv_id, search):
+            return None
+        try:
+            return self.__get_connected(tv_id)
+        except Exception as e:
+            logging.error('Couldn\'t connect to TV {}: {}'.format(tv_id, e))
+            return None
+
+    def __get_connected(self, tv_id):
+        with self.__lock:
+            tv_lock = self.__tv_locks.setdefault(tv_id, threading.Lock())
+        with tv_lock:
+            client = self.__clients.get(tv_id)
+            connected = False
+            if client is None or client.terminated:
+                with self.__lock:
+                    self.__clients.pop(tv_id, None)
+                client = self.__connect(tv_id)  # Raises if the TV can't be reached
+                connected = client is not None
+            with self.__lock:
+                if client is None:
+                    self.__clients.pop(tv_id, None)
+                else:
+                    self.__clients[tv_id] = client
+                    self.__last_used[tv_id] = time.time()
+                    self.__start_reaper()
+            if connected:
+                for fn in self.__listeners:
+                    try:
+                        fn(tv_id, client)
+                    except Exception:
+                        logging.exception('Connect listener for TV {} failed'.format(tv_id))
+            return client
+
+    def add_connect_listener(self, fn):
+        """Call fn(tv_id, client) for every new connection, e.g. to subscribe to events on it"""
+        self.__listeners.append(fn)
+
+    def keep_alive(self, tv_ids, heartbeat_interval=10, heartbeat_timeout=5):
+        """Connect to tv_ids now and keep them connected from a thread.
+
+        Every heartbeat_interval seconds each connection is pinged, and one
+        the TV hasn't answered for heartbeat_timeout seconds after that is
+        closed and made again. Kept TVs are never closed for being idle.
+        """
+        with self.__lock:
+            self.__kept.update(tv_ids)
+            if self.__supervisor is not None:
+                return
+            self.__supervisor = threading.Thread(target=self.__supervise, args=(heartbeat_interval, heartbeat_timeout), name='lgtv-pool-supervisor')
+            self.__supervisor.daemon = True
+        self.__supervisor.start()
+
+    def __supervise(self, heartbeat_interval, heartbeat_timeout):
+        backoff = {}  # TV id to the current reconnect backoff
+        next_attempt = {}  # TV id to when to try connecting again
+        next_ping = {}  # TV id to when to ping its connection
+        while True:
+            now = time.time()
+            with self.__lock:
+                kept = [(tv_id, self.__clients.get(tv_id)) for tv_id in self.__kept if tv_id not in self.__booting]
+            for tv_id, client in kept:
+                if client is not None and not client.terminated:
+                    backoff.pop(tv_id, None)
+                    if now - client.last_heard > heartbeat_interval + heartbeat_timeout:
+                        logging.warning('TV {} stopped answering, reconnecting'.format(tv_id))
+                        client.close()
+                        client.close_connection()  # Don't wait for a close handshake from a dead peer
+                    elif now >= next_ping.get(tv_id, 0):
+                        next_ping[tv_id] = now + heartbeat_interval
+                        try:
+                            client.ping('lgtv')
+                        except Exception as e:
+                            logging.info('Ping to TV {} failed: {}'.format(tv_id, e))
+                    continue
+                if now < next_attempt.get(tv_id, 0):
+                    continue
+                # Only the cache is asked where the TV went, a TV that is off would cost a search every retry
+                if self.__get(tv_id, search=False) is None:
+                    delay = min(backoff.get(tv_id, self.RECONNECT_MIN_SECONDS / 2) * 2, self.RECONNECT_MAX_SECONDS)
+                    backoff[tv_id] = delay
+                    # Jitter, so TVs (and processes) that failed together don't retry in lockstep
+                    next_attempt[tv_id] = time.time() + delay * random.uniform(0.5, 1)
+                else:
+                    next_ping[tv_id] = time.time() + heartbeat_interval
+            time.sleep(min(1, self.RECONNECT_MIN_SECONDS))
+
+    def __connect(self, tv_id):
+        if not self.registry.has(tv_id):
+            logging.error('No settings for TV {}, try "python lgtv.py auth [IP Address] {}"'.format(tv_id, tv_id))
+            return None
+        client = LGTVClient(persistent=True, port=self.port, settings_file=self.registry.settings_file(tv_id))
+        client.sock.settimeout(self.handshake_timeout)  # Don't hang on a TV that is off
+        client.connect()
+        if not client.wait_for_handshake(self.handshake_timeout):
+            logging.error('Handshake with TV {} failed, try "python lgtv.py auth [IP Address] {}"'.format(tv_id, tv_id))
+            client.close()
+            return None
+        logging.info('Connected to TV {}'.format(tv_id))
+        return client
+
+    def __relocate(self, tv_id, search=True):
+        """Search for tv_id by uuid and store its new address, returns True if it moved"""
+        settings = self.registry.load(tv_id)
+        if self.discovery is None or not settings.get('uuid') or settings['hostname'] != settings['ip']:
+            return False  # Nothing to look it up by, or a host name DNS keeps current
+        if search:
+            self.discovery.invalidate(settings['uuid'])
+            entry = self.discovery.lookup(settings['uuid'])
+        else:
+            entry = ([tv for tv in self.discovery.tvs() if tv['uuid'] == settings['uuid']] or [None])[0]
+        if entry is None or entry['address'] == settings['ip']:
+            return False
+        logging.info('TV {} moved from {} to {}'.format(tv_id, settings['ip'], entry['address']))
+        self.registry.update(tv_id, {'hostname': entry['address'], 'ip': entry['address']})
+        return True
+
+    def power_on(self, tv_id):
+        """Wake tv_id up and connect from a thread once it accepts connections.
+
+        The magic packets always go out: a connection that looks open may be
+        to a TV in standby, or one that was turned off without closing it.
+
+        Returns:
+            True if the TV was woken
+        """
+        settings = self.registry.load(tv_id)
+        if not settings.get('mac-address'):
+            logging.error('No MAC address for TV {}, it must have been powered on and paired before power on works'.format(tv_id))
+            return False
+        sendMagicPackets(settings['mac-address'])
+        with self.__lock:
+            client = self.__clients.get(tv_id)
+            if client is not None and not client.terminated:
+                return True  # Nothing to wait for, commands go out on the open connection
+            booting = tv_id in self.__booting
+            if not booting:
+                self.__booting[tv_id] = []
+        if not booting:
+            boot = threading.Thread(target=self.__boot, args=(tv_id, settings), name='lgtv-boot-{}'.format(tv_id))
+            boot.daemon = True
+            boot.start()
+        return True
+
+    def when_ready(self, tv_id, fn):
+        """Run fn(client) once tv_id has booted and is connected.
+
+        Returns:
+            False, without running fn, if tv_id isn't booting
+        """
+        with self.__lock:
+            if tv_id not in self.__booting:
+                return False
+            self.__booting[tv_id].append(fn)
+            return True
+
+    def __boot(self, tv_id, settings):
+        started = time.time()
+        last_burst = started
+        interval = self.BOOT_PROBE_INTERVAL
+        client = None
+        while time.time() - started < self.boot_timeout:
+            # The port opens a little before the TV takes a handshake, __get() retries it next round if so
+            if isPortOpen(settings['hostname'], self.port, interval):
+                client = self.__get(tv_id, search=False)  # It is listening where we think it is
+                if client is not None:
+                    logging.info('TV {} ready {:.1f}s after power on'.format(tv_id, time.time() - started))
+                    break
+            time.sleep(interval)
+            interval = min(interval * 2, self.BOOT_PROBE_MAX_INTERVAL)
+            if time.time() - last_burst > self.WOL_RESEND_SECONDS:
+                sendMagicPackets(settings['mac-address'])
+                last_burst = time.time()
+        else:
+            logging.error('TV {} didn\'t come up within {} seconds of power on'.format(tv_id, self.boot_timeout))
+
+        # Commands queued while running earlier ones still go before new ones, which wait until this is empty
+        while True:
+            with self.__lock:
+                waiting = self.__booting[tv_id]
+                if not waiting:
+                    del self.__booting[tv_id]
+                    break
+                self.__booting[tv_id] = []
+            for fn in waiting:
+                if client is None:
+                    logging.error('Dropping command {} for TV {}'.format(fn, tv_id))
+                    continue
+                try:
+                    fn(client)
+                except Exception:
+                    logging.exception('Queued command for TV {} failed'.format(tv_id))
+
+    def evict_idle(self):
+        """Close the connections that haven't been handed out for idle_timeout seconds"""
+        now = time.time()
+        with self.__lock:
+            idle = [tv_id for tv_id, last_used in self.__last_used.items()
+                    if now - last_used > self.idle_timeout and tv_id not in self.__kept]
+            clients = [(tv_id, self.__clients.pop(tv_id, None)) for tv_id in idle]
+            for tv_id in idle:
+                del self.__last_used[tv_id]
+        for tv_id, client in clients:
+            if client is not None and not client.terminated:
+                logging.info('Closing idle connection to TV {}'.format(tv_id))
+                client.close()
+
+    def close_all(self):
+        with self.__lock:
+            clients, self.__clients, self.__last_used = self.__clients.values(), {}, {}
+            self.__kept.clear()  # Or the supervisor would connect again
+        for client in clients:
+            if not client.terminated:
+                client.close()
+
+    def __start_reaper(self):
+        # Called with self.__lock held
+        if self.__reaper is None and self.idle_timeout:
+            self.__reaper = threading.Thread(target=self.__reap, name='lgtv-pool-reaper')
+            self.__reaper.daemon = True
+            self.__reaper.start()
+
+    def __reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2.0))
+            self.evict_idle()
+
+
+def normalizeTitle(title):
+    """Lower case words of title, the way a voice command names an app, e.g. "amazon prime video" for "Amazon Prime-Video"
+
+    Accents are dropped rather than splitting words, "Pokémon TV" is "pokemon tv". Returns a str.
+    """
+    if not isinstance(title, unicode):
+        title = title.decode('utf-8', 'replace')
+    title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore')
+    return ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+
+
+class LGTVAppIndex(object):
+    """The apps of a TV by normalized title, e.g. "prime video" -> "amazon", kept on disk.
+
+    subscribe() fills it from listLaunchPoints and keeps it current as apps are
+    installed and removed, so app triggers are there before the TV is queried.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.__apps = {}  # Normalized title to app id
+        self.__listeners = []
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    # Drop the empty title indexes written before such titles were skipped
+                    self.__apps = dict((title.encode('utf-8'), app_id.encode('utf-8'))
+                                       for title, app_id in json.loads(f.read()).items() if title)
+            except ValueError:
+                logging.warning('Ignoring corrupt app index {}'.format(self.path))
+
+    def apps(self):
+        return dict(self.__apps)
+
+    def add_listener(self, fn):
+        """Call fn() from the connection's thread whenever apps are installed or removed"""
+        self.__listeners.append(fn)
+
+    def subscribe(self, client):
+        return client.subscribeApps(self.update)
+
+    def update(self, response):
+        """Apply a listLaunchPoints response: the full list, or a single app added/updated/removed"""
+        payload = response.get('payload') or {}
+        if response.get('type') == 'error' or payload.get('returnValue') is False:
+            logging.error('Bad launch points response: {}'.format(response))
+            return
+        if 'launchPoints' in payload:
+            apps = {}
+            for launch_point in payload['launchPoints']:
+                self.__add(apps, launch_point)
+        elif payload.get('change') in ('added', 'updated'):
+            apps = dict((title, app_id) for title, app_id in self.__apps.items() if app_id != payload.get('id'))
+            self.__add(apps, payload)
+        elif payload.get('change') == 'removed':
+            removed_id = payload.get('id') or payload.get('launchPointId')
+            apps = dict((title, app_id) for title, app_id in self.__apps.items() if app_id != removed_id)
+        else:
+            return
+        if apps == self.__apps:
+            return
+        self.__apps = apps
+        self.save()
+        for fn in self.__listeners:
+            fn()
+
+    @staticmethod
+    def __add(apps, launch_point):
+        title, app_id = normalizeTitle(launch_point.get('title') or ''), launch_point.get('id')
+        if not app_id:
+            return
+        if isinstance(app_id, unicode):
+            app_id = app_id.encode('utf-8')  # Like the titles, trigger names and their IDs are bytes
+        if not title:
+            # No letters or digits to say, e.g. a title in another script
+            logging.info(u'Skipping app {} ({}), its title has no name to trigger it by'.format(app_id, launch_point.get('title')))
+        elif apps.get(title, app_id) != app_id:
+            logging.warning(u'Apps {} and {} are both called "{}", keeping {}'.format(apps[title], app_id, title, apps[title]))
+        else:
+            apps[title] = app_id
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        temp_path = self.path + '.tmp'
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, 'w') as f:
+                f.write(json.dumps(self.__apps))
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Couldn\'t save app index {}: {}'.format(self.path, e))
+
+
+class LGTVMacro(object):
+    """A declarative sequence of LGTVClient commands, run over one connection.
+
+    Steps are dicts of a command and its arguments, e.g.
+        [{"command": "setInput", "input_id": "HDMI_1"},
+         {"command": "setVolume", "level": 25},
+         {"command": "startApp", "appid": "netflix"}]
+    and are sent back to back without waiting for replies, so the whole
+    macro costs about one round trip. Only steps that change what is on
+    screen wait for the previous one of their kind to be answered, as the TV
+    may finish them out of order; "wait": true makes a step wait for every
+    step before it, "wait": false never waits.
+    """
+    # Commands that change the foreground app or input, see above
+    SERIAL_COMMANDS = set(['setInput', 'startApp', 'closeApp', 'openAppWithPayload', 'openBrowserAt',
+                           'openYoutubeId', 'openYoutubeURL', 'setTVChannel', 'off'])
+    STEP_TIMEOUT = 10  # Seconds to wait for the reply a step waits on, and for each reply at the end
+
+    def __init__(self, steps):
+        """Raises ValueError for a step that isn't a valid LGTVClient command"""
+        self.steps = [self.__validate(step) for step in steps]
+
+    @staticmethod
+    def __validate(step):
+        if not isinstance(step, dict) or 'command' not in step:
+            raise ValueError('Macro step {} has no command'.format(json.dumps(step)))
+        command = step['command']
+        if command not in getCommands(LGTVClient) or command == 'on':
+            raise ValueError('Macro step {}: {} is not a command that can run on a connection'.format(json.dumps(step), command))
+        spec = getargspec(LGTVClient.__dict__[command])
+        names = [name for name in spec.args[1:] if name != 'callback']
+        required = spec.args[1:len(spec.args) - len(spec.defaults or ())]
+        kwargs = dict((key, value) for key, value in step.items() if key not in ('command', 'wait'))
+        unknown = [key for key in kwargs if key not in names]
+        missing = [name for name in required if name not in kwargs]
+        if unknown or missing:
+            raise ValueError('Macro step {}: {} takes {}'.format(json.dumps(step), command, ', '.join(names) or 'no arguments'))
+        return command, kwargs, step.get('wait')
+
+    def run(self, client, timeout=STEP_TIMEOUT):
+        """Send the steps on client, returns their replies in step order, None for a step left unanswered"""
+        requests = []
+        last_serial = None
+        for command, kwargs, wait in self.steps:
+            if wait is True:
+                for request in requests:
+                    request.wait(timeout)
+            elif wait is None and command in self.SERIAL_COMMANDS and last_serial is not None:
+                last_serial.wait(timeout)
+            request = getattr(client, command)(**kwargs)
+            requests.append(request)
+            if command in self.SERIAL_COMMANDS:
+                last_serial = request
+        return [request.wait(timeout) for request in requests]
+
+    def failures(self, responses):
+        """(command, reply) of every step run() got an error or no reply for"""
+        return [(command, response) for (command, kwargs, wait), response in zip(self.steps, responses)
+                if response is None or response.get('type') == 'error' or (response.get('payload') or {}).get('returnValue') is False]
+
+
+class LGTVDaemonServer(SocketServer.ThreadingUnixStreamServer):
+    # A client left connected must not keep the daemon from exiting
+    daemon_threads = True
+
+
+class LGTVDaemonRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if line.strip():
+                self.wfile.write(json.dumps(self.server.lgtv_daemon.run(line)) + '\n')
+                self.wfile.flush()
+
+
+class LGTVDaemon(object):
+    """Holds the paired connection to a TV and runs commands sent over a Unix socket on it.
+
+    Each line sent is a command as a JSON object, in the form of an LGTVMacro
+    step, e.g. {"command": "setVolume", "level": 10}, and is answered with a
+    line of the TV's JSON response. forwardCommand() is the client side.
+    """
+    def __init__(self, path=DAEMON_SOCKET, tv_id=LGTVRegistry.DEFAULT_TV, pool=None):
+        self.path = os.path.expanduser(path)
+        self.tv_id = tv_id
+        self.pool = pool or LGTVPool(idle_timeout=0, discovery=LGTVDiscoveryCache())
+        self.__server = None
+
+    def run(self, line):
+        """Run one JSON command line, returns the TV's response"""
+        try:
+            step = json.loads(line)
+            # A subscription would outlive the request, with nowhere to send its updates
+            if isinstance(step, dict) and str(step.get('command')).startswith('subscribe'):
+                raise ValueError('{} is not a command the daemon can run'.format(step['command']))
+            macro = LGTVMacro([step])
+        except ValueError as e:
+            return {"type": "error", "error": str(e), "payload": {}}
+        client = self.pool.get(self.tv_id)
+        if client is None:
+            return {"type": "error", "error": "TV {} is unreachable or still booting".format(self.tv_id), "payload": {}}
+        response = macro.run(client)[0]
+        if response is None:
+            return {"type": "error", "error": "no response from the TV", "payload": {}}
+        return response
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            if forwardCommand('{}', self.path) is not None:
+                raise Exception('Another daemon is listening on {}'.format(self.path))
+            os.remove(self.path)  # Left behind by a daemon that didn't exit cleanly
+        # Whoever can connect controls the TV, so the socket is ours alone from the moment it exists
+        umask = os.umask(077)
+        try:
+            self.__server = LGTVDaemonServer(self.path, LGTVDaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        self.__server.lgtv_daemon = self
+        # Pair now and stay connected, so no command waits for a handshake
+        self.pool.keep_alive([self.tv_id])
+        logging.info('Taking commands for TV {} on {}'.format(self.tv_id, self.path))
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.server_close()
+            self.__server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self.pool.close_all()
+
+
+def forwardCommand(line, path=DAEMON_SOCKET):
+    """Send a JSON command line to a running LGTVDaemon, returns its response or None if there is no daemon"""
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(line.strip() + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        reply = sock.makefile().readline()
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    return json.loads(reply) if reply else None
+
+
+def parseBatchLine(line):
+    """An LGTVMacro step from a batch line: a JSON object, or a command and its arguments as on the command line"""
+    if line.startswith('{'):
+        step = json.loads(line)
+    else:
+        argv = shlex.split(line)
+        if argv[0] not in getCommands(LGTVClient):
+            raise ValueError('{} is not a command'.format(argv[0]))
+        step = parseargs(argv[0], argv[1:])
+        step['command'] = argv[0]
+    LGTVMacro([step])  # Raises ValueError for a bad command or arguments
+    return step
+
+
+def runBatch(lines, settings_file=SETTINGS_FILE, handshake_timeout=5):
+    """Run the commands of lines, one per line, pipelined over one connection.
+
+    Prints one JSON response line per command, in order, an error for a line
+    that doesn't parse. Blank lines and lines starting with # are skipped.
+
+    Returns:
+        True if every command succeeded
+    """
+    results = []  # Per command, the error of a bad line or None for a step that runs
+    steps = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            steps.append(parseBatchLine(line))
+            results.append(None)
+        except Exception as e:
+            results.append({"type": "error", "error": "{}: {}".format(line, e), "payload": {}})
+
+    responses = []
+    if steps:
+        macro = LGTVMacro(steps)
+        ws = LGTVClient(persistent=True, settings_file=settings_file)
+        try:
+            ws.connect()
+        except socket.error as e:
+            logging.error('Couldn\'t connect to the TV: {}'.format(e))
+        else:
+            if ws.wait_for_handshake(handshake_timeout):
+                responses = macro.run(ws)
+            if not ws.terminated:
+                ws.close()
+            # Let the socket thread finish closing before the interpreter goes away under it
+            deadline = time.time() + handshake_timeout
+            while not ws.terminated and time.time() < deadline:
+                time.sleep(0.01)
+        if not responses:
+            responses = [{"type": "error", "error": "not connected to the TV", "payload": {}}] * len(steps)
+        failures = macro.failures(responses)
+        responses = [response or {"type": "error", "error": "no response from the TV", "payload": {}} for response in responses]
+    else:
+        failures = []
+
+    responses = iter(responses)
+    for result in results:
+        print json.dumps(result or next(responses))
+    sys.stdout.flush()
+    return not failures and all(result is None for result in results)
 
 
 def usage(error=None):
@@ -416,8 +1540,10 @@ def usage(error=None):
     print
     print "Available Commands:"
 
-    print "  scan"
-    print "  auth                  Hostname/IP    Authenticate and exit, creates initial config ~/.lgtv.json"
+    print "  scan                  [refresh]      List TVs, from the discovery cache until their max-age runs out"
+    print "  auth                  Hostname/IP [TV id]    Authenticate and exit, creates initial config ~/.lgtv.json or ~/.lgtv/<TV id>.json"
+    print "  daemon                Stay connected and take commands on ~/.lgtv.sock, which the other commands then go through"
+    print "  batch                 [file]         Run a command per line of file or stdin over one connection, as text or JSON"
 
     for c in getCommands(LGTVClient):
         print "  " + c,
@@ -458,7 +1584,10 @@ if __name__ == '__main__':
     if len(sys.argv) < 2:
         usage("Too few arguments")
     elif sys.argv[1] == "scan":
-        results = LGTVScan()
+        discovery = LGTVDiscoveryCache()
+        results = discovery.tvs()
+        if not results or sys.argv[2:] == ["refresh"]:
+            results = discovery.refresh()
         if len(results) > 0:
             print json.dumps({
                 "result": "ok",
@@ -476,16 +1605,36 @@ if __name__ == '__main__':
     elif sys.argv[1] == "auth":
         if len(sys.argv) < 3:
             usage("Hostname or IP is required for auth")
-        ws = LGTVClient(sys.argv[2])
+        if len(sys.argv) > 3:
+            ws = LGTVClient(sys.argv[2], settings_file=LGTVRegistry().prepare(sys.argv[3]), discovery=LGTVDiscoveryCache())
+        else:
+            ws = LGTVClient(sys.argv[2], discovery=LGTVDiscoveryCache())
         ws.connect()
         ws.run_forever()
+    elif sys.argv[1] == "batch":
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.WARNING, datefmt='%H:%M:%S')
+        lines = open(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] != '-' else sys.stdin
+        sys.exit(0 if runBatch(lines) else 1)
+    elif sys.argv[1] == "daemon":
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+        daemon = LGTVDaemon()
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
     else:
+        try:
+            args = parseargs(sys.argv[1], sys.argv[2:])
+        except Exception as e:
+            usage(e.message)
+            sys.exit(1)
+        # A running daemon already has the connection, and saves us the handshake
+        response = forwardCommand(json.dumps(dict(args, command=sys.argv[1])))
+        if response is not None:
+            print json.dumps(response)
+            sys.exit(0)
         try:
             ws = LGTVClient()
-            try:
-                args = parseargs(sys.argv[1], sys.argv[2:])
-            except Exception as e:
-                usage(e.message)
             ws.connect()
             ws.exec_command(sys.argv[1], args)
             ws.run_forever()
@@ -0,0 +1,163 @@
+"""metrics.py: Counters and latency histograms, served in the Prometheus text format
+
+Metrics are created once at module level by the code they measure, e.g.
+
+    SEARCHES = metrics.counter('fauxmo_ssdp_searches_received_total', 'M-SEARCH requests received')
+    SEARCHES.inc()
+    ACT_SECONDS = metrics.histogram('alexa_tv_act_seconds', 'Time to act on a trigger', ['command'])
+    with ACT_SECONDS.time(command='volume'):
+        ...
+
+and every metric created is served by metrics_endpoint, which plugs into a
+fauxmo.upnp_http_server like any other device.
+"""
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds, from a fast loop callback to a TV that takes its time
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []  # Every metric created, in creation order
+registry_lock = threading.Lock()
+
+
+def escape(value):
+    value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class metric(object):
+    """Base class, keeps one value per combination of label values."""
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}  # Tuple of label values to the value
+        self.lock = threading.Lock()
+        with registry_lock:
+            registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} takes the labels {}, got {}'.format(self.name, self.label_names, sorted(labels)))
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(self.render_value(key, value) for key, value in items)
+        return '\n'.join(lines)
+
+
+class counter(metric):
+    """A count that only goes up, e.g. requests received."""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def render_value(self, key, value):
+        return '{}{} {}'.format(self.name, format_labels(self.label_names, key), format_value(value))
+
+
+class histogram(metric):
+    """Distribution of durations in seconds, counted into cumulative buckets."""
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(histogram, self).__init__(name, help_text, label_names)
+
+    def observe(self, seconds, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                # Per bucket counts (the last one is +Inf), then the sum
+                value = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            value[0][index] += 1
+            value[1] += seconds
+
+    def time(self, **labels):
+        """Context manager observing the time spent in its block."""
+        return timed(self, labels)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, key, 'le="{}"'.format(format_value(bound))), cumulative))
+        labels = format_labels(self.label_names, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return '\n'.join(lines)
+
+
+class timed(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    with registry_lock:
+        metrics = list(registry)
+    return '\n'.join(one_metric.render() for one_metric in metrics) + '\n'
+
+
+class metrics_endpoint(object):
+    """Serves render() at /metrics from a fauxmo.upnp_http_server."""
+    PATH = '/metrics'
+
+    def get_name(self):
+        return 'metrics'
+
+    def get_paths(self):
+        return [self.PATH]
+
+    def handle_request(self, request, connection):
+        if request.method != 'GET' or request.path != self.PATH:
+            connection.send('HTTP/1.1 404 Not Found\r\nCONTENT-LENGTH: 0\r\nCONNECTION: close\r\n\r\n')
+            return
+        body = render()
+        connection.send('HTTP/1.1 200 OK\r\n'
+                        'CONTENT-TYPE: text/plain; version=0.0.4\r\n'
+                        'CONTENT-LENGTH: {}\r\n'
+                        'CONNECTION: close\r\n'
+                        '\r\n{}'.format(len(body), body))